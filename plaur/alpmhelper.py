@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""the privileged helper of the alpm install backend, see plaur.installer
+
+It reads a JSON object with the keys 'files', 'asdeps' and 'asexplicit' from
+stdin, installs the package files in a single libalpm transaction, sets the
+install reasons of the given package names and reports the progress as one
+JSON object per line on stdout. It does not import plaur, such that it can be
+run as root without plaur's environment.
+"""
+
+import json
+import os
+import sys
+
+
+def report(kind, **fields):
+    fields['type'] = kind
+    print(json.dumps(fields), flush=True)
+
+def describe_error(e):
+    # pyalpm errors carry the message, the errno and possibly a list of
+    # details, e.g. the conflicting files
+    message = str(e.args[0]) if e.args else str(e)
+    if len(e.args) > 2 and e.args[2]:
+        message += ': ' + ', '.join(str(d) for d in e.args[2])
+    return message
+
+def install(request):
+    import pyalpm
+    import pycman.config
+    handle = pycman.config.PacmanConfig(conf='/etc/pacman.conf').initialize_alpm()
+    def progress(target, percent, total, current):
+        report('progress', target=target, percent=percent, total=total, current=current)
+    def log(level, line):
+        if level & (pyalpm.LOG_ERROR | pyalpm.LOG_WARNING):
+            report('log', message=line.rstrip('\n'))
+    handle.progresscb = progress
+    handle.logcb = log
+    # like pacman -U --asdeps/--asexplicit, the transaction installs all
+    # packages with the install reason of the majority
+    if len(request['asdeps']) > len(request['asexplicit']):
+        (flags, others, other_reason) = ({ 'alldeps': True }, request['asexplicit'],
+                                         pyalpm.PKG_REASON_EXPLICIT)
+    else:
+        (flags, others, other_reason) = ({ 'allexplicit': True }, request['asdeps'],
+                                         pyalpm.PKG_REASON_DEPEND)
+    try:
+        packages = [ handle.load_pkg(f) for f in request['files'] ]
+        transaction = handle.init_transaction(**flags)
+        try:
+            for pkg in packages:
+                transaction.add_pkg(pkg)
+            transaction.prepare()
+            transaction.commit()
+        finally:
+            transaction.release()
+        if others:
+            # like pacman -D, set the other reasons in an empty transaction,
+            # which holds the lock of the database
+            local_db = handle.get_localdb()
+            transaction = handle.init_transaction()
+            try:
+                for name in others:
+                    pkg = local_db.get_pkg(name)
+                    if pkg is not None and pkg.reason != other_reason:
+                        handle.set_pkgreason(pkg, other_reason)
+            finally:
+                transaction.release()
+    except pyalpm.error as e:
+        report('error', message=describe_error(e))
+        return False
+    return True
+
+def dry_run(request):
+    # go through the motions without libalpm and without root
+    files = request['files']
+    for i,f in enumerate(files):
+        if not os.path.isfile(f):
+            report('error', message="could not find or read package: %s" % f)
+            return False
+        report('progress', target=os.path.basename(f), percent=100,
+               total=len(files), current=i + 1)
+    return True
+
+def main(args):
+    request = json.load(sys.stdin)
+    success = dry_run(request) if '--dry-run' in args else install(request)
+    if success:
+        report('done')
+    return 0 if success else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
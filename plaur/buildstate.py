@@ -0,0 +1,81 @@
+"""a persistent record of the packages whose package files are built"""
+
+import json
+import os
+import threading
+
+from plaur.utils import *
+
+
+class BuildState:
+    # remembers for each package path the key under which all its package
+    # files were found, consisting of the verified commit, the pkgver and the
+    # PKGEXT, together with the modification time and size of each file. As
+    # long as the key matches and the files are unchanged, the package is
+    # still built, without computing the package file names again. The
+    # directory of the package is no indicator, because makepkg modifies it
+    # on every run. Saved as JSON.
+    format_version = 2
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = None # loaded on demand
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def read(self):
+        self.records = { }
+        try:
+            with open(self.filename) as fh:
+                data = json.load(fh)
+            if data.get('version') == BuildState.format_version:
+                self.records = data['packages']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, AttributeError) as e:
+            debug("Ignoring broken build state %s: %s" % (self.filename, str(e)))
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmpfile = self.filename + '.tmp'
+            with open(tmpfile, 'w') as fh:
+                json.dump({ 'version': BuildState.format_version,
+                            'packages': self.records }, fh)
+            os.replace(tmpfile, self.filename)
+            self.dirty = False
+
+    # return the pair (modification time, size) of the file, or None if it
+    # does not exist
+    @staticmethod
+    def file_stat(filepath):
+        try:
+            st = os.stat(filepath)
+        except FileNotFoundError:
+            return None
+        return [ st.st_mtime_ns, st.st_size ]
+
+    # tell whether the package files of path were found under the given key
+    # in the directory and did not change since
+    def is_built(self, path, key, directory):
+        with self.lock:
+            if self.records is None:
+                self.read()
+            record = self.records.get(path)
+        if record is None or record['key'] != key:
+            return False
+        for filename,stat in record['files'].items():
+            if BuildState.file_stat(os.path.join(directory, filename)) != stat:
+                return False
+        return True
+
+    # record that the given package files of path exist in the directory
+    # under the given key
+    def set_built(self, path, key, directory, filenames):
+        files = { f: BuildState.file_stat(os.path.join(directory, f)) for f in filenames }
+        with self.lock:
+            if self.records is None:
+                self.read()
+            self.records[path] = { 'key': key, 'files': files }
+            self.dirty = True
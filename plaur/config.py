@@ -2,6 +2,8 @@
 import configparser
 import os
 
+from plaur.utils import UserErrorMessage
+
 plaur_ini = "plaur.ini" # filename of the central plaur configuration file
 
 class PlaurConfig:
@@ -14,6 +16,49 @@ class PlaurConfig:
             # some description
             'packages_file': ("packages.ini",
                   "file path to packages config, relative to the plaur git root"),
+            'native_refs': ("yes",
+                  "resolve git refs by reading the git directories instead of calling git"),
+            'fetch_jobs': ("10",
+                  "number of packages fetched in parallel"),
+            'fetch_timeout': ("",
+                  "seconds after which a git call during fetch is aborted (empty: never)"),
+            'fetch_retries': ("1",
+                  "how often fetching a package is retried after it failed"),
+            'clone_strategy': ("full",
+                  "how packages are cloned unless set per package: full, shallow (only the "
+                  + "latest commit) or blobless (file contents are downloaded on demand)"),
+            'shared_objects': ("no",
+                  "keep the git objects of all packages in one shared store in "
+                  + ".git/plaur/objects.git, see the share command"),
+            'mirror_url': ("",
+                  "url of a repository with one branch per package, e.g. "
+                  + "https://github.com/archlinux/aur.git. If set, fetch updates a local "
+                  + "copy of it once and updates the packages from there"),
+            'build_jobs': ("1",
+                  "number of packages built in parallel"),
+            'build_cpus': ("",
+                  "number of CPU slots shared by parallel builds via MAKEFLAGS (empty: all "
+                  + "cores if build_jobs is greater than 1, otherwise MAKEFLAGS is not touched). "
+                  + "Has no effect if MAKEFLAGS is set in makepkg.conf. Unless "
+                  + "build_jobserver is set, a build keeps the share it got when it "
+                  + "started, even after the other builds finished"),
+            'build_jobserver': ("no",
+                  "share the build_cpus among parallel builds via a GNU make jobserver "
+                  + "instead of splitting them when a build starts. Then a build that "
+                  + "remains alone uses all build_cpus, but only if it is built by GNU "
+                  + "make, and every build may run one job more than its share"),
+            'install_backend': ("pacman",
+                  "how built packages are installed: pacman (via sudo pacman), alpm (in a "
+                  + "single libalpm transaction by a helper run via sudo) or fake (only "
+                  + "pretends to install, for testing)"),
+            'break_cycles': ("no",
+                  "break dependency cycles among packages to build by ignoring dependencies "
+                  + "that are only makedepends, assuming they are installed already"),
+            'cycle_breaks': ("",
+                  "space separated list of dependencies PATH:NAME that are ignored if "
+                  + "the package at PATH is in a dependency cycle via the package NAME"),
+            'conditional_fetch': ("yes",
+                  "only pull packages whose remote HEAD differs from the local HEAD"),
         }
     def set_filename_from_git(self, git):
         global plaur_ini
@@ -23,13 +68,33 @@ class PlaurConfig:
     # this function should return a read-only reference...
     def __getitem__(self,key):
         if key in self.file['options']:
-            return self.file['options']['key']
+            return self.file['options'][key]
         elif key in self.defaults:
             (v,_) = self.defaults[key]
             return v
         else:
             return None
 
+    def getboolean(self, key):
+        value = self[key]
+        if value is None:
+            return None
+        value = str(value).lower()
+        if value not in self.file.BOOLEAN_STATES:
+            raise UserErrorMessage("Invalid boolean value »%s« for option %s in %s"
+                                   % (value, key, plaur_ini))
+        return self.file.BOOLEAN_STATES[value]
+
+    def getint(self, key):
+        value = self[key]
+        if value is None or str(value).strip() == '':
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise UserErrorMessage("Invalid number »%s« for option %s in %s"
+                                   % (value, key, plaur_ini))
+
     def read(self):
         self.file.read(self.filename)
     def write(self):
@@ -0,0 +1,245 @@
+"""a persistent dependency graph of the packages in the plaur repository"""
+
+import json
+import os
+
+from plaur import srcinfo
+from plaur.utils import *
+
+
+class DepGraph:
+    # stores for each package path the package names it provides and the
+    # dependencies it has, as found in its .SRCINFO. Every record is keyed by
+    # the commit it was computed from (the verified commit, or HEAD for
+    # packages that were never verified), so only packages whose commit
+    # moved are read again. The graph is saved as JSON.
+    format_version = 2
+    # the .SRCINFO keys of the dependencies of a package
+    dependency_keys = [ 'makedepends', 'depends', 'checkdepends' ]
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = None # loaded on demand
+        self.dirty = False
+
+    def read(self):
+        self.records = { }
+        try:
+            with open(self.filename) as fh:
+                data = json.load(fh)
+            if data.get('version') == DepGraph.format_version:
+                self.records = data['packages']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, AttributeError) as e:
+            debug("Ignoring broken dependency graph %s: %s" % (self.filename, str(e)))
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmpfile = self.filename + '.tmp'
+        with open(tmpfile, 'w') as fh:
+            json.dump({ 'version': DepGraph.format_version, 'packages': self.records }, fh)
+        os.replace(tmpfile, self.filename)
+        self.dirty = False
+
+    # the commit the record of the package has to be computed from, or None
+    # if the package does not exist yet
+    @staticmethod
+    def record_key(package):
+        verified = package.settings['verified']
+        if verified != '':
+            return 'verified:' + verified
+        if not package.git.exists():
+            return None
+        try:
+            return 'head:' + package.git.HEAD()
+        except UserErrorMessage:
+            return None
+
+    @staticmethod
+    def make_record(key, package):
+        info = package.load_srcinfo()
+        record = { 'key': key }
+        record['pkgnames'] = list(info.packages())
+        record['versions'] = { n: info.full_version(n) for n in record['pkgnames'] }
+        record['provides'] = info.query_any('provides')
+        for k in DepGraph.dependency_keys:
+            record[k] = info.query_any(k)
+        return record
+
+    # bring the records of the given paths of the PackageConfig up to date
+    # and return the set of paths without a .SRCINFO
+    def update(self, packs, paths):
+        if self.records is None:
+            self.read()
+            # drop the records of paths removed from the PackageConfig
+            for path in [ p for p in self.records if p not in packs.config ]:
+                debug("Dropping the dependency graph entry of removed %s" % path)
+                del self.records[path]
+                self.dirty = True
+        outdated = [ ]
+        for path in paths:
+            key = DepGraph.record_key(packs[path])
+            record = self.records.get(path)
+            if key is None or record is None or record['key'] != key:
+                outdated.append((path, key))
+        packs.preload_srcinfos([ path for path,_ in outdated ])
+        stale = [ ]
+        missing = set()
+        for path,key in outdated:
+            package = packs[path]
+            try:
+                self.set_record(path, key, DepGraph.make_record(key, package))
+            except FileNotFoundError as e:
+                debug("Can not open .SRCINFO of %s: %s" % (package.path, str(e)))
+                stale.append(package)
+        generated = packs.generate_srcinfos(stale)
+        for package in stale:
+            if package.path in generated:
+                key = DepGraph.record_key(package)
+                self.set_record(package.path, key, DepGraph.make_record(key, package))
+            else:
+                missing.add(package.path)
+                self.set_record(package.path, None, None)
+        return missing
+
+    def set_record(self, path, key, record):
+        if record is None:
+            if self.records.pop(path, None) is not None:
+                self.dirty = True
+            return
+        debug("Updating the dependency graph entry of %s" % path)
+        self.records[path] = record
+        # records of packages that do not exist yet are not saved
+        self.dirty = self.dirty or key is not None
+        if key is None:
+            record['key'] = None
+
+    # return the list of package names provided by the record
+    @staticmethod
+    def provided_names(record):
+        names = record['pkgnames'] + record['provides']
+        return list(srcinfo.SRCINFO.drop_version_constraints(names))
+
+    # return the list of dependencies of the record, including their version
+    # constraints
+    @staticmethod
+    def dependency_strings(record):
+        deps = [ ]
+        for k in DepGraph.dependency_keys:
+            deps += record[k]
+        return deps
+
+    # build the ProviderIndex of the given paths
+    def provider_index(self, paths):
+        providers = ProviderIndex()
+        for path in paths:
+            record = self.records.get(path)
+            if record is not None:
+                providers.add_record(path, record)
+        return providers
+
+    # return the set of pairs (name, path) such that path needs the package
+    # name only for building, i.e. only as makedepends
+    def makedepends_only(self, paths):
+        edges = set()
+        for path in paths:
+            record = self.records.get(path)
+            if record is None:
+                continue
+            other = { split_dependency(d)[0] for d in record['depends'] + record['checkdepends'] }
+            for dep in record['makedepends']:
+                name = split_dependency(dep)[0]
+                if name not in other:
+                    edges.add((name, path))
+        return edges
+
+    # return the pair of dictionaries (dependencies, provides) as described
+    # in PackageConfig.compute_depgraph(), restricted to the given paths.
+    # The keys of dependencies are the dependencies including their version
+    # constraints. provides maps these and every provided package name to
+    # the paths satisfying it.
+    def maps(self, paths):
+        providers = self.provider_index(paths)
+        dependencies = { }
+        provides = { }
+        for path in paths:
+            record = self.records.get(path)
+            if record is None:
+                continue
+            for dep in DepGraph.dependency_strings(record):
+                dependencies.setdefault(dep, []).append(path)
+            for name in DepGraph.provided_names(record):
+                provides.setdefault(name, []).append(path)
+        for dep in dependencies:
+            if dep not in provides:
+                satisfied_by = providers.resolve(dep)
+                if satisfied_by:
+                    provides[dep] = satisfied_by
+        return (dependencies, provides)
+
+
+class ProviderIndex:
+    # maps package names to the paths providing them, together with the
+    # provided version, such that a dependency with a version constraint is
+    # resolved by a dictionary lookup and version comparisons.
+    def __init__(self):
+        # maps a name to a list of pairs (path, version), where version is
+        # None for provides without a version
+        self.index = { }
+
+    def add(self, name, path, version):
+        self.index.setdefault(name, []).append((path, version))
+
+    def add_record(self, path, record):
+        for name in record['pkgnames']:
+            self.add(name, path, record['versions'].get(name))
+        for prov in record['provides']:
+            (name, op, version) = split_dependency(prov)
+            self.add(name, path, version if op == '=' else None)
+
+    # return the list of paths satisfying the dependency, e.g. "foo>=1.0"
+    def resolve(self, dep):
+        (name, op, constraint) = split_dependency(dep)
+        paths = [ ]
+        for path,version in self.index.get(name, []):
+            if path not in paths and version_satisfies(version, op, constraint):
+                paths.append(path)
+        return paths
+
+
+class PathIndex:
+    # an index of the edges between paths, built once from the dictionaries
+    # (dependencies, provides) as returned by PackageConfig.compute_depgraph().
+    # A path P requires a path Q if Q provides a name that P depends on.
+    def __init__(self, dependencies, provides):
+        # maps each path to the list of names it provides
+        self.provided = { }
+        # maps each path to a dictionary mapping each name it provides to the
+        # list of paths depending on that name
+        self.required_by = { }
+        # maps each path to a dictionary mapping each name it depends on to
+        # the list of paths providing that name
+        self.requires = { }
+        for name,provided_by in provides.items():
+            for path in provided_by:
+                self.provided.setdefault(path, []).append(name)
+                self.required_by.setdefault(path, { })[name] = dependencies.get(name, [])
+        for name,required_by in dependencies.items():
+            for path in required_by:
+                self.requires.setdefault(path, { })[name] = provides.get(name, [])
+
+    # return the list of pairs (name, path) such that path depends on the name
+    # provided by the given path
+    def dependents(self, path):
+        return [ (name, p)
+                 for name,paths in self.required_by.get(path, { }).items()
+                 for p in paths if p != path ]
+
+    # return the list of pairs (name, path) such that the given path depends on
+    # the name provided by path
+    def providers(self, path):
+        return [ (name, p)
+                 for name,paths in self.requires.get(path, { }).items()
+                 for p in paths if p != path ]
@@ -0,0 +1,221 @@
+"""fetch many packages in parallel"""
+
+import datetime
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from plaur.utils import *
+
+
+class FetchResult:
+    # the outcome of fetching a single package path
+    def __init__(self, path):
+        self.path = path
+        # one of 'cloned', 'unchanged', 'updated' or 'failed'
+        self.status = None
+        self.old_head = None
+        self.new_head = None
+        self.error = None
+        self.duration = 0.0
+        self.attempts = 0
+
+    def __str__(self):
+        hashlength = 10
+        if self.status == 'failed':
+            return "%s failed: %s" % (self.path, self.error)
+        elif self.status == 'updated':
+            return "%s updated %s..%s" % (self.path,
+                                          self.old_head[0:hashlength],
+                                          self.new_head[0:hashlength])
+        elif self.status == 'cloned':
+            return "%s cloned at %s" % (self.path, (self.new_head or '')[0:hashlength])
+        else:
+            return "%s unchanged" % self.path
+
+
+class Fetcher:
+    # fetches the paths of a PackageConfig with a pool of jobs threads.
+    # Each git call is aborted after timeout seconds (None means never) and
+    # a failed package is retried up to retries times. If conditional is set,
+    # then only packages whose remote HEAD moved are pulled. If a Mirror is
+    # given, then all packages it contains are updated from there.
+    def __init__(self, packs, jobs=10, timeout=None, retries=1, conditional=True,
+                 mirror=None):
+        self.packs = packs
+        self.mirror = mirror
+        self.conditional = conditional
+        self.jobs = max(1, jobs)
+        self.timeout = timeout
+        self.retries = max(0, retries)
+
+    # update the mirror with a single fetch and return the set of paths that
+    # can be updated from it
+    def sync_mirror(self, paths):
+        if self.mirror is None:
+            return set()
+        print("Updating mirror of %s" % self.mirror.url)
+        try:
+            heads = self.mirror.remote_heads(timeout=self.timeout)
+            mirrored = set()
+            stale = [ ]
+            for p in paths:
+                package = self.packs[p]
+                branch = package.mirror_branch()
+                if branch not in heads:
+                    continue
+                mirrored.add(p)
+                if self.conditional and self.mirror.head(branch) == heads[branch]:
+                    # already in the mirror
+                    continue
+                stale.append(branch)
+            self.mirror.update(stale, timeout=self.timeout)
+        except UserErrorMessage as e:
+            error_msg("Updating the mirror failed, fetching directly: %s" % e)
+            return set()
+        debug("%d packages are in the mirror, %d branches were fetched"
+              % (len(mirrored), len(stale)))
+        return mirrored
+
+    def fetch_one(self, path, from_mirror=False):
+        result = FetchResult(path)
+        start = time.monotonic()
+        try:
+            self.fetch_attempts(result, from_mirror)
+        except Exception as e:
+            # e.g. an empty repository without HEAD, as the AUR serves for
+            # unknown names. It must not abort the other fetches.
+            debug("Fetching %s failed: %s" % (path, repr(e)))
+            result.status = 'failed'
+            result.error = str(e) or type(e).__name__
+        result.duration = time.monotonic() - start
+        return result
+
+    # fetch the package of result.path, retrying on errors, and fill in the
+    # result
+    def fetch_attempts(self, result, from_mirror):
+        package = self.packs[result.path]
+        if package.git.exists():
+            try:
+                result.old_head = package.git.HEAD()
+            except UserErrorMessage:
+                pass
+        while result.attempts <= self.retries:
+            result.attempts += 1
+            try:
+                result.status = package.fetch(timeout=self.timeout,
+                                              conditional=self.conditional,
+                                              mirror=self.mirror if from_mirror else None)
+                result.error = None
+                break
+            except UserErrorMessage as e:
+                debug("Fetching %s failed (attempt %d): %s" % (result.path, result.attempts, e))
+                result.status = 'failed'
+                result.error = str(e)
+        if result.status != 'failed':
+            result.new_head = package.git.HEAD()
+
+    # fetch all the given paths and return the list of FetchResult objects
+    # in the order of completion
+    def run(self, paths):
+        results = [ ]
+        if not paths:
+            return results
+        mirrored = self.sync_mirror(paths)
+        progressbar = ProgressBar() if sys.stdout.isatty() else None
+        start = time.monotonic()
+        with ThreadPoolExecutor(self.jobs) as pool:
+            futures = [ pool.submit(self.fetch_one, p, p in mirrored) for p in paths ]
+            for f in as_completed(futures):
+                results.append(f.result())
+                self.report(results[-1], len(results), len(paths), start, progressbar)
+        if progressbar is not None:
+            progressbar.set(1.0)
+        return results
+
+    def report(self, result, done, total, start, progressbar):
+        elapsed = time.monotonic() - start
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = (total - done) / rate if rate > 0 else 0.0
+        stats = "[%d/%d, %.1f/s, ETA %s]" % (done, total, rate, format_duration(eta))
+        if result.status == 'failed':
+            # the error message is part of the summary
+            print("%s %s failed" % (stats, result.path))
+        elif result.status != 'unchanged':
+            print("%s %s (%s)" % (stats, result, format_duration(result.duration)))
+        if progressbar is not None:
+            progressbar.set(done / total, text=stats)
+
+    @staticmethod
+    def print_summary(results):
+        counts = { }
+        for r in results:
+            counts.setdefault(r.status, []).append(r)
+        print("Fetched %d packages: %d cloned, %d updated, %d unchanged, %d failed." % (
+            len(results),
+            len(counts.get('cloned', [])),
+            len(counts.get('updated', [])),
+            len(counts.get('unchanged', [])),
+            len(counts.get('failed', []))))
+        changed = counts.get('cloned', []) + counts.get('updated', [])
+        if changed:
+            print("Changed: %s" % ' '.join(sorted(r.path for r in changed)))
+        for r in sorted(counts.get('failed', []), key=lambda r: r.path):
+            error_msg("%s (after %d attempts)" % (r, r.attempts))
+
+
+class FetchJournal:
+    # a local, untracked log of fetch runs. Each line of the file is a JSON
+    # object describing the fetch of one package in one run. Only the last
+    # keep_runs runs are kept.
+    def __init__(self, filename, keep_runs=50):
+        self.filename = filename
+        self.keep_runs = keep_runs
+
+    def append(self, results):
+        run = datetime.datetime.now().isoformat(timespec='milliseconds')
+        with open(self.filename, 'a') as fh:
+            for r in results:
+                record = {
+                    'run': run,
+                    'path': r.path,
+                    'status': r.status,
+                    'old': r.old_head,
+                    'new': r.new_head,
+                    'duration': round(r.duration, 3),
+                    'attempts': r.attempts,
+                    'error': r.error,
+                }
+                fh.write(json.dumps(record) + '\n')
+        runs = self.runs()
+        if len(runs) > self.keep_runs:
+            self.write(runs[-self.keep_runs:])
+
+    # return a list of pairs (run, records) in chronological order, where
+    # records is the list of dictionaries of that run
+    def runs(self):
+        runs = [ ]
+        try:
+            with open(self.filename) as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        debug("Skipping invalid line in %s" % self.filename)
+                        continue
+                    if not runs or runs[-1][0] != record['run']:
+                        runs.append((record['run'], [ ]))
+                    runs[-1][1].append(record)
+        except FileNotFoundError:
+            pass
+        return runs
+
+    def write(self, runs):
+        tmpfile = self.filename + '.tmp'
+        with open(tmpfile, 'w') as fh:
+            for _,records in runs:
+                for record in records:
+                    fh.write(json.dumps(record) + '\n')
+        os.replace(tmpfile, self.filename)
@@ -9,74 +9,458 @@ import os
 import sys
 import re
 import subprocess
+import threading
+import atexit
+import collections
+import selectors
+import time
+
+# git subcommands that never modify the repository. Calling any other
+# subcommand invalidates the running batch processes of a Git object.
+read_only_commands = {
+    'cat-file', 'diff', 'for-each-ref', 'log', 'ls-files', 'ls-remote', 'rev-parse',
+    'show',
+}
+
+class BatchCheck:
+    # a long-lived »git cat-file --batch-check« process for one repository.
+    # it answers object lookups like HEAD, refs/heads/master or :path (the
+    # index entry of path) without forking a new git process per query.
+    # If contents is set, then it is a »git cat-file --batch« process, which
+    # also returns the contents of the objects. The objects of the object
+    # directories in alternates are also found.
+    def __init__(self, git, contents=False, alternates=None):
+        self.git = git
+        self.contents = contents
+        self.alternates = alternates or [ ]
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        mode = '--batch' if self.contents else '--batch-check'
+        command = git_prefix(self.git) + ['cat-file', mode]
+        debug("Starting »%s«" % ' '.join(command))
+        env = None
+        if self.alternates:
+            env = dict(os.environ)
+            env['GIT_ALTERNATE_OBJECT_DIRECTORIES'] = ':'.join(self.alternates)
+        self.proc = subprocess.Popen(command,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL,
+                                     env=env)
+        start_batch(self)
+
+    # look up the given object name and return a quadruple
+    # (object id, object type, size, contents) or None if the object does not
+    # exist. The contents are None unless the contents flag is set.
+    def query(self, name):
+        if '\n' in name:
+            return None
+        data = None
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self.start()
+            else:
+                use_batch(self)
+            try:
+                self.proc.stdin.write((name + '\n').encode('utf-8'))
+                self.proc.stdin.flush()
+                line = self.proc.stdout.readline().decode('utf-8')
+                fields = line.split()
+                if self.contents and len(fields) == 3:
+                    # the contents are followed by a line break
+                    data = self.proc.stdout.read(int(fields[2]) + 1)[:-1]
+            except BrokenPipeError:
+                line = ''
+        if line == '':
+            # git died, e.g. because the repository does not exist
+            self.close()
+            return None
+        if len(fields) != 3:
+            # e.g. "HEAD missing" or "HEAD ambiguous"
+            return None
+        return (fields[0], fields[1], int(fields[2]), data)
+
+    # look up the given object name and return a triple
+    # (object id, object type, size) or None if the object does not exist
+    def lookup(self, name):
+        obj = self.query(name)
+        return None if obj is None else obj[0:3]
+
+    # return the contents of the given object name as bytes, or None if the
+    # object does not exist
+    def read(self, name):
+        obj = self.query(name)
+        return None if obj is None else obj[3]
+
+    def close(self):
+        with self.lock:
+            self.stop()
+
+    # stop the process, the lock must be held
+    def stop(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.proc.wait()
+        self.proc.stdout.close()
+        self.proc = None
+
+# the running batch processes, least recently used first. Every process
+# holds two pipes, so with many package repositories only the
+# max_running_batches most recently used ones are kept running; the others
+# are stopped and restarted on their next query.
+max_running_batches = 16
+running_batches = collections.OrderedDict()
+running_batches_lock = threading.Lock()
+
+# register a newly started batch process and stop the least recently used
+# ones if there are too many. The lock of batch must be held.
+def start_batch(batch):
+    use_batch(batch)
+    with running_batches_lock:
+        victims = list(running_batches)[:-max_running_batches]
+        for victim in victims:
+            del running_batches[victim]
+    for victim in victims:
+        # a victim that is busy right now was just used, so it can keep
+        # running. Not waiting for it avoids a deadlock with a thread that
+        # holds the lock of the victim and is starting a process itself.
+        if victim.lock.acquire(blocking=False):
+            try:
+                victim.stop()
+            finally:
+                victim.lock.release()
+        else:
+            use_batch(victim)
+
+# mark a running batch process as recently used
+def use_batch(batch):
+    with running_batches_lock:
+        running_batches[batch] = True
+        running_batches.move_to_end(batch)
+
+@atexit.register
+def close_batches():
+    with running_batches_lock:
+        batches = list(running_batches)
+        running_batches.clear()
+    for b in batches:
+        b.close()
+
+# object ids are sha1 or sha256 hashes in hexadecimal notation
+object_id_re = re.compile('^([0-9a-f]{40}|[0-9a-f]{64})$')
+
+class RefResolver:
+    # resolves refs of a repository by reading HEAD, loose refs and
+    # packed-refs directly from the git directory. For every layout it does
+    # not understand (linked worktrees, gitfiles, reftable, deep symref
+    # chains), it returns None such that the caller can fall back to git.
+    max_symref_depth = 5
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+
+    # tells whether the git directory has a layout that is understood
+    def supported_layout(self):
+        if not os.path.isdir(self.git_dir):
+            # e.g. a gitfile of a submodule or a linked worktree
+            return False
+        for name in ['commondir', 'reftable']:
+            if os.path.exists(os.path.join(self.git_dir, name)):
+                return False
+        return True
+
+    # read a file from the git directory and return its first line, or None
+    # if it does not exist
+    def read_line(self, name):
+        try:
+            with open(os.path.join(self.git_dir, name)) as fh:
+                return fh.readline().strip()
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            return None
+
+    # look up a fully qualified ref name in packed-refs
+    def packed_ref(self, refname):
+        try:
+            with open(os.path.join(self.git_dir, 'packed-refs')) as fh:
+                for line in fh:
+                    if line.startswith('#') or line.startswith('^'):
+                        continue
+                    fields = line.rstrip('\n').split(' ', 1)
+                    if len(fields) == 2 and fields[1] == refname:
+                        return fields[0]
+        except FileNotFoundError:
+            pass
+        return None
+
+    # return the object id the given ref (e.g. 'HEAD' or 'refs/heads/master')
+    # points to, or None if it cannot be determined without git
+    def resolve(self, refname):
+        if not self.supported_layout():
+            return None
+        for _ in range(0, self.max_symref_depth):
+            if refname != 'HEAD' and (not refname.startswith('refs/')
+                                      or '..' in refname.split('/')):
+                return None
+            content = self.read_line(refname)
+            if content is None and refname != 'HEAD':
+                content = self.packed_ref(refname)
+            if content is None:
+                # e.g. an unborn branch
+                return None
+            if content.startswith('ref: '):
+                refname = content[len('ref: '):]
+                continue
+            if object_id_re.match(content):
+                return content
+            return None
+        return None
+
+# return an UserErrorMessage for a git call with the given arguments that
+# exited with the given status and stderr
+def call_failed(args, status, err):
+    err = re.sub("[\r\n]*$", "", err)
+    cmd = ' '.join(list(args))
+    if err == '':
+        return UserErrorMessage("git %s failed with status %d." % (cmd, status))
+    else:
+        return UserErrorMessage("git %s failed with status %s: %s" %
+                                (cmd, status, err))
+
+# return an UserErrorMessage for a git call that took longer than timeout
+def call_timed_out(args, timeout):
+    cmd = ' '.join(list(args))
+    return UserErrorMessage("git %s timed out after %s seconds" % (cmd, timeout))
+
+# the command prefix for calling git on the given Git object
+def git_prefix(git):
+    if git.git_work_tree is None:
+        return [ 'git', '--git-dir=' + git.git_dir ]
+    return [ 'git',
+             '--work-tree=' + git.git_work_tree,
+             '--git-dir=' + git.git_dir,
+    ]
 
 class Git:
+    # whether refs are resolved by reading the git directory directly
+    # instead of asking git
+    native_refs = True
+
     # create a wrapper objects to access the git repository
-    # whose git root is at path
-    def __init__(self, path):
-        self.git_dir = path + "/.git"
-        self.git_work_tree = path
-
-    # call a git command without redirecting stderr or stdout
-    def plain_call(self, *args):
-        git_prefix = [ 'git',
-                       '--work-tree=' + self.git_work_tree,
-                       '--git-dir=' + self.git_dir,
-        ]
-        command = git_prefix + list(args)
+    # whose git root is at path. For bare repositories, path is the git
+    # directory itself and there is no work tree.
+    def __init__(self, path, bare=False):
+        if bare:
+            self.git_dir = path
+            self.git_work_tree = None
+        else:
+            self.git_dir = path + "/.git"
+            self.git_work_tree = path
+        self.batch = None
+        self.cat = None
+        self.refs = RefResolver(self.git_dir)
+
+    # return the BatchCheck object of this repository
+    def batch_check(self):
+        if self.batch is None:
+            self.batch = BatchCheck(self)
+        return self.batch
+
+    # return the BatchCheck object of this repository that returns contents
+    def batch_cat(self):
+        if self.cat is None:
+            self.cat = BatchCheck(self, contents=True)
+        return self.cat
+
+    # stop the batch processes, e.g. because the repository was modified
+    def invalidate(self):
+        for b in [self.batch, self.cat]:
+            if b is not None:
+                b.close()
+
+    # call a git command without redirecting stderr. If stdout is given,
+    # then the output of git is written to this file object directly.
+    # returns the exit status of git
+    def plain_call(self, *args, stdout=None, timeout=None):
+        command = git_prefix(self) + list(args)
         debug("Calling »%s«" % ' '.join(command))
-        proc = subprocess.Popen(command)
-        return proc.wait()
+        proc = subprocess.Popen(command, stdout=stdout)
+        try:
+            status = proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            raise call_timed_out(args, timeout)
+        finally:
+            if not args or args[0] not in read_only_commands:
+                self.invalidate()
+        return status
 
     # call a git subcommand, returning a tuple:
     # stdout,stderr,status
-    def call(self, *args):
-        git_prefix = [ 'git',
-                       '--work-tree=' + self.git_work_tree,
-                       '--git-dir=' + self.git_dir,
-        ]
-        command = git_prefix + list(args)
+    # raises an UserErrorMessage if git does not finish within timeout seconds
+    def call(self, *args, timeout=None):
+        command = git_prefix(self) + list(args)
         debug("Calling »%s«" % ' '.join(command))
         proc = subprocess.Popen(command,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE)
-        status = proc.wait()
-        stdout = proc.stdout.read().decode("utf-8")
-        stderr = proc.stderr.read().decode("utf-8")
+        try:
+            # read both pipes while waiting, such that git never blocks on
+            # a full pipe
+            stdout, stderr = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise call_timed_out(args, timeout)
+        finally:
+            if not args or args[0] not in read_only_commands:
+                self.invalidate()
+        status = proc.returncode
+        stdout = stdout.decode("utf-8")
+        stderr = stderr.decode("utf-8")
         return stdout, stderr, status
 
     # call a successful, i.e. raise an UserErrorMessage
     # if the command exists with a status other than 0.
     # returns stdout as a string
-    def call_success(self, *args):
-        out,err,status = self.call(*args)
+    def call_success(self, *args, timeout=None):
+        out,err,status = self.call(*args, timeout=timeout)
         if status != 0:
-            err = re.sub("[\r\n]*$", "", err)
-            cmd = ' '.join(list(args))
-            if err == '':
-                raise UserErrorMessage("git %s failed with status %d." % (cmd, status))
-            else:
-                raise UserErrorMessage("git %s failed with status %s: %s" %
-                                        (cmd, status, err))
+            raise call_failed(args, status, err)
         if err != '':
             # just pass stderr
             print("git: %s" % err, file=sys.stderr)
         return out
 
+    # call a git subcommand and yield its stdout incrementally: as chunks of
+    # at most chunk_size bytes, or line by line (including the line break) if
+    # lines is set. Only the last stderr_limit bytes of stderr are kept.
+    # raises an UserErrorMessage if git fails or if it does not finish within
+    # timeout seconds. If the caller stops iterating, git is killed.
+    def stream(self, *args, lines=False, timeout=None, chunk_size=65536,
+               stderr_limit=65536):
+        command = git_prefix(self) + list(args)
+        debug("Streaming »%s«" % ' '.join(command))
+        proc = subprocess.Popen(command,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        selector = selectors.DefaultSelector()
+        selector.register(proc.stdout, selectors.EVENT_READ)
+        selector.register(proc.stderr, selectors.EVENT_READ)
+        err = b''
+        pending = b'' # incomplete line in lines mode
+        try:
+            while selector.get_map():
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise call_timed_out(args, timeout)
+                for key,_ in selector.select(remaining):
+                    data = os.read(key.fileobj.fileno(), chunk_size)
+                    if data == b'':
+                        selector.unregister(key.fileobj)
+                    elif key.fileobj is proc.stderr:
+                        err = (err + data)[-stderr_limit:]
+                    elif lines:
+                        pending += data
+                        *complete, pending = pending.split(b'\n')
+                        for l in complete:
+                            yield l + b'\n'
+                    else:
+                        yield data
+            if pending != b'':
+                yield pending
+            try:
+                status = proc.wait(timeout=remaining)
+            except subprocess.TimeoutExpired:
+                raise call_timed_out(args, timeout)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            selector.close()
+            proc.stdout.close()
+            proc.stderr.close()
+            if not args or args[0] not in read_only_commands:
+                self.invalidate()
+        if status != 0:
+            raise call_failed(args, status, err.decode("utf-8", "replace"))
+
     # tells wether a certain file is tracked by git
     # filepath can either be absolute or relative to the CWD
     def is_tracked(self, filepath):
-        _,_,status = self.call('ls-files', '--error-unmatch', filepath);
-        return (status == 0);
+        relpath = self.relative_path(filepath)
+        if relpath is None or os.path.isdir(filepath):
+            # let git decide about paths outside of the work tree and
+            # about directories
+            _,_,status = self.call('ls-files', '--error-unmatch', filepath);
+            return (status == 0);
+        # ask the index via the batch process
+        return self.batch_check().lookup(':' + relpath) is not None
+
+    # returns the given path (absolute or relative to the CWD) relative to
+    # the root of the working tree, or None if it is outside of the working
+    # tree
+    def relative_path(self, filepath):
+        root = os.path.realpath(self.git_work_tree)
+        path = os.path.realpath(filepath)
+        if path == root:
+            return ''
+        if not path.startswith(root.rstrip('/') + '/'):
+            return None
+        return os.path.relpath(path, root)
 
-    # tells whether the git is a plaur repository
+    # tells whether the git is a plaur repository. Since the check whether
+    # plaur.ini is tracked requires git, its positive result is cached in the
+    # plaur directory, keyed by the state of the index.
     def is_plaur_repo(self):
         pf = os.path.join(self.git_work_tree, plaur.config.plaur_ini)
-        return self.is_tracked(pf);
+        if not os.path.isfile(pf):
+            return False
+        try:
+            st = os.stat(os.path.join(self.git_dir, 'index'))
+            index_state = '%d %d\n' % (st.st_mtime_ns, st.st_size)
+        except (FileNotFoundError, NotADirectoryError):
+            index_state = None
+        cache_file = os.path.join(self.git_dir, 'plaur', 'plaur-ini-tracked')
+        if index_state is not None:
+            try:
+                with open(cache_file) as fh:
+                    if fh.read() == index_state:
+                        return True
+            except OSError:
+                pass
+        tracked = self.is_tracked(pf)
+        if tracked and index_state is not None:
+            try:
+                with open(os.path.join(self.plaur_dir(), 'plaur-ini-tracked'), 'w') as fh:
+                    fh.write(index_state)
+            except OSError as e:
+                debug("Can not cache the plaur repository check: %s" % str(e))
+        return tracked
+
+    # returns the directory within the git directory where plaur keeps its
+    # local, untracked state. It is created if it does not exist yet.
+    def plaur_dir(self):
+        path = os.path.join(self.git_dir, 'plaur')
+        os.makedirs(path, exist_ok=True)
+        return path
 
     # returns the CWD relative to the root of the working tree
     def prefix_of_cwd(self):
-        return self.call_success('rev-parse', '--show-prefix').strip()
+        relpath = self.relative_path(os.getcwd())
+        if relpath is None:
+            # let git produce the appropriate error message
+            return self.call_success('rev-parse', '--show-prefix').strip()
+        return relpath + '/' if relpath != '' else ''
 
     # returns the absolute path of the working dir
     def work_tree(self):
@@ -86,6 +470,15 @@ class Git:
     def exists(self):
         return os.path.isdir(self.git_work_tree) and os.path.isdir(self.git_dir)
 
+    # tells whether the repository is a shallow clone
+    def is_shallow(self):
+        return os.path.isfile(os.path.join(self.git_dir, 'shallow'))
+
+    # tell whether this is a partial clone, e.g. a blobless one
+    def is_partial(self):
+        (out, _, _) = self.call('config', '--get', 'extensions.partialclone')
+        return out.strip() != ''
+
     # exit with an error message if the git directory does not exist
     def assert_exists(self):
         if not os.path.isdir(self.git_dir):
@@ -94,7 +487,15 @@ class Git:
             raise UserErrorMessage("Git work tree %s does not exist" % self.git_work_tree)
 
     def HEAD(self):
-        return self.call_success('rev-parse', 'HEAD').strip()
+        if Git.native_refs:
+            head = self.refs.resolve('HEAD')
+            if head is not None:
+                return head
+        obj = self.batch_check().lookup('HEAD')
+        if obj is None:
+            # let git produce the appropriate error message
+            return self.call_success('rev-parse', 'HEAD').strip()
+        return obj[0]
 
     # write the given lines to the .git/info/exclude
     # mark them as autogenerated and replace an existing autogenerated section
@@ -142,6 +543,140 @@ class Git:
                 fh.write(l + '\n')
 
 
+class ObjectStore:
+    # a bare repository whose objects are shared with package repositories
+    # via git alternates. The objects of every imported repository are kept
+    # reachable by refs below refs/plaur/<name>/, such that they are never
+    # pruned while some package repository borrows them.
+    def __init__(self, path):
+        self.path = path
+        self.git = Git(path, bare=True)
+        self.lock = threading.Lock()
+
+    # the objects directory, as it is listed in the alternates file
+    def objects_dir(self):
+        return os.path.join(self.path, 'objects')
+
+    # create the bare repository if it does not exist yet
+    def ensure(self):
+        with self.lock:
+            if not os.path.isdir(self.objects_dir()):
+                self.git.call_success('init', '--quiet', '--bare')
+
+    # return a dictionary mapping the refs below the given prefix to the
+    # object ids they point to, with the prefix removed
+    @staticmethod
+    def refs(git, prefix):
+        out = git.call_success('for-each-ref', '--format=%(objectname) %(refname)', prefix)
+        refs = { }
+        for line in out.splitlines():
+            (oid, _, refname) = line.partition(' ')
+            refs[refname[len(prefix):]] = oid
+        return refs
+
+    # copy all objects of the given repository into the store and make the
+    # repository borrow them from there: its own copies are dropped. The
+    # commit verified is kept reachable as well, even if the branches are
+    # force-pushed later. Shallow and partial clones are not complete, so
+    # they can not be imported; for them, False is returned.
+    def import_repo(self, name, repo, verified=None):
+        if repo.is_shallow() or repo.is_partial():
+            return False
+        self.ensure()
+        prefix = 'refs/plaur/%s/' % name.strip('/')
+        refspecs = [ '+refs/heads/*:%sheads/*' % prefix ]
+        if verified is not None:
+            # make the package repository reference it, too
+            repo.call_success('update-ref', 'refs/plaur/verified', verified)
+            refspecs.append('+refs/plaur/verified:%sverified' % prefix)
+        expected = ObjectStore.refs(repo, 'refs/heads/')
+        expected = { 'heads/' + r: oid for r,oid in expected.items() }
+        if verified is not None:
+            expected['verified'] = verified
+        with self.lock:
+            self.git.call_success('fetch', '--quiet', '--no-tags', repo.git_dir, *refspecs)
+            if verified is None:
+                self.git.call_success('update-ref', '-d', prefix + 'verified')
+            imported = ObjectStore.refs(self.git, prefix)
+        # git fetch may reject refs without failing, so check that every ref
+        # arrived before dropping the objects from the package repository
+        missing = [ r for r,oid in expected.items() if imported.get(r) != oid ]
+        if missing:
+            raise UserErrorMessage("Importing %s into the shared object store failed for: %s"
+                                   % (name, ' '.join(sorted(missing))))
+        alternates = os.path.join(repo.git_dir, 'objects', 'info', 'alternates')
+        try:
+            with open(alternates) as fh:
+                entries = fh.read().splitlines()
+        except FileNotFoundError:
+            entries = []
+        if self.objects_dir() not in entries:
+            os.makedirs(os.path.dirname(alternates), exist_ok=True)
+            with open(alternates, 'a') as fh:
+                fh.write(self.objects_dir() + '\n')
+        # repack without the objects available in the alternates
+        repo.call_success('repack', '-a', '-d', '-l', '-q')
+        return True
+
+class Mirror:
+    # a local bare copy of selected branches of a remote repository that has
+    # one branch per package, like the git mirror of the whole AUR. Package
+    # repositories are updated from this copy, such that only a single fetch
+    # from the network is needed for all of them.
+    def __init__(self, path, url):
+        self.path = path
+        self.url = url
+        self.git = Git(path, bare=True)
+
+    # create the bare repository if it does not exist yet
+    def ensure(self):
+        if not os.path.isdir(os.path.join(self.path, 'objects')):
+            self.git.call_success('init', '--quiet', '--bare')
+
+    # returns a dictionary mapping the branches of the remote to object ids
+    def remote_heads(self, timeout=None):
+        self.ensure()
+        out = self.git.call_success('ls-remote', '--heads', self.url, timeout=timeout)
+        heads = { }
+        for line in out.splitlines():
+            fields = line.split('\t')
+            if len(fields) == 2 and fields[1].startswith('refs/heads/'):
+                heads[fields[1][len('refs/heads/'):]] = fields[0]
+        return heads
+
+    # fetch the given branches from the remote with a single git fetch
+    def update(self, branches, timeout=None):
+        if not branches:
+            return
+        self.ensure()
+        refspecs = [ '+%s:%s' % (self.ref(b), self.ref(b)) for b in branches ]
+        self.git.call_success('fetch', '--quiet', '--no-tags', self.url, *refspecs,
+                              timeout=timeout)
+
+    # the ref of the given branch in the local copy
+    def ref(self, branch):
+        return 'refs/heads/' + branch
+
+    # the object id the branch points to in the local copy, or None
+    def head(self, branch):
+        return self.git.refs.resolve(self.ref(branch))
+
+# return the absolute path of the innermost directory containing cwd that has
+# a .git entry, or None, if there is no such directory. In contrast to
+# detect_git(), this walks up the file system without calling git, unless
+# the environment overrides the git directory.
+def find_git_root(cwd='.'):
+    if 'GIT_DIR' in os.environ or 'GIT_WORK_TREE' in os.environ:
+        return detect_git(cwd=cwd)
+    path = os.path.realpath(cwd)
+    while True:
+        if os.path.exists(os.path.join(path, '.git')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
 # return the absolute path of the git root for the current working directory
 # without trailing slashes, or None, if cwd does not live in a git repository
 def detect_git(cwd='.'):
@@ -0,0 +1,106 @@
+"""backends installing built package files, selected by install_backend"""
+
+import json
+import os
+import subprocess
+import sys
+
+from plaur.utils import *
+
+
+class PacmanInstaller:
+    # installs via sudo pacman -U. The install reason of the majority of the
+    # packages is passed to pacman -U, the others are set by pacman -D.
+    def install(self, files, asdeps, asexplicit):
+        if len(asdeps) > len(asexplicit):
+            (reason, others, other_reason) = ('--asdeps', asexplicit, '--asexplicit')
+        else:
+            (reason, others, other_reason) = ('--asexplicit', asdeps, '--asdeps')
+        pacman = [ 'sudo', 'pacman', '-U', '--noconfirm', reason ]
+        pacman += files
+        proc = subprocess.Popen(pacman)
+        status = proc.wait()
+        if status != 0:
+            error_msg("pacman -U failed with exit status %d" % status)
+            return False
+        if others:
+            pacman = [ 'sudo', 'pacman', '-D', other_reason ]
+            pacman += others
+            proc = subprocess.Popen(pacman)
+            status = proc.wait()
+            if status != 0:
+                # the packages are installed nevertheless
+                error_msg("pacman -D %s failed with exit status %d for: %s"
+                          % (other_reason, status, ' '.join(others)))
+        return True
+
+
+class AlpmInstaller:
+    # installs in a single libalpm transaction, which also sets the install
+    # reason of the majority of the packages, like the PacmanInstaller. The
+    # transaction runs in the helper alpmhelper.py as root, which reports its
+    # progress as JSON lines.
+    helper = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alpmhelper.py')
+
+    def command(self):
+        return [ 'sudo', sys.executable, AlpmInstaller.helper ]
+
+    def install(self, files, asdeps, asexplicit):
+        request = { 'files': files, 'asdeps': asdeps, 'asexplicit': asexplicit }
+        proc = subprocess.Popen(self.command(), stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, universal_newlines=True)
+        proc.stdin.write(json.dumps(request))
+        proc.stdin.close()
+        progressbar = ProgressBar() if sys.stdout.isatty() else None
+        done = False
+        failed = False
+        for line in proc.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                # not from the helper itself, e.g. from python
+                print(line, end='')
+                continue
+            kind = message.get('type')
+            if kind == 'progress':
+                if progressbar is not None:
+                    progressbar.set(message['percent'] / 100, message['target'])
+                elif message['percent'] == 100 and message['target']:
+                    print("  (%d/%d) %s" % (message['current'], message['total'],
+                                            message['target']))
+            elif kind == 'log':
+                print("  " + message['message'])
+            elif kind == 'error':
+                error_msg("Installing failed: " + message['message'])
+                failed = True
+            elif kind == 'done':
+                done = True
+        status = proc.wait()
+        if status != 0 and not failed:
+            error_msg("%s failed with exit status %d" % (' '.join(self.command()), status))
+        return done and status == 0
+
+
+class FakeInstaller(AlpmInstaller):
+    # runs the helper of the AlpmInstaller in dry-run mode, which neither
+    # needs root nor libalpm and installs nothing
+    def command(self):
+        return [ sys.executable, AlpmInstaller.helper, '--dry-run' ]
+
+    def install(self, files, asdeps, asexplicit):
+        print("Pretending to install: " + ' '.join(asexplicit + asdeps))
+        return AlpmInstaller.install(self, files, asdeps, asexplicit)
+
+
+backends = {
+    'pacman': PacmanInstaller,
+    'alpm': AlpmInstaller,
+    'fake': FakeInstaller,
+}
+
+def backend(name):
+    """Return the installer with the given name"""
+    if name not in backends:
+        raise UserErrorMessage("Unknown install_backend »%s«, expected one of: %s"
+                               % (name, ', '.join(backends)))
+    return backends[name]()
@@ -11,11 +11,9 @@ import subprocess
 import queue
 import time
 import shutil
-from concurrent.futures import ThreadPoolExecutor
+import signal
 
 
-import pyalpm
-import pycman
 #from pycman import config
 #from pycman import action_deptest
 
@@ -26,11 +24,15 @@ from plaur import utils
 from plaur import packageconfig
 import plaur.package as P
 import plaur.config
+import plaur.fetcher
+import plaur.scheduler
+import plaur.depgraph
+import plaur.installer
 
 
 # returns a Git object for the plaur repository
 def assert_plaur_git():
-    gitpath = gitwrapper.detect_git();
+    gitpath = gitwrapper.find_git_root();
     if gitpath == None:
         raise UserErrorMessage("Not in a plaur git repository")
     git = plaur.gitwrapper.Git(gitpath)
@@ -39,7 +41,7 @@ def assert_plaur_git():
         # then maybe it's just a pkgbuild repo, so try the parent directory as
         # well:
         (gitpath,_) = os.path.split(gitpath.rstrip('/'))
-        gitpath = gitwrapper.detect_git(cwd=gitpath)
+        gitpath = gitwrapper.find_git_root(cwd=gitpath)
         if gitpath == None:
             raise UserErrorMessage("Not in a plaur git repository")
         git = plaur.gitwrapper.Git(gitpath)
@@ -48,6 +50,7 @@ def assert_plaur_git():
     #print(gitpath)
     global config
     config.set_filename_from_git(git)
+    gitwrapper.Git.native_refs = config.getboolean('native_refs')
     return git
 
 #--------------- classes  ---------------
@@ -89,7 +92,7 @@ def cmd_init(args):
     """Usage: init
 
     Initialize an empty plaur repository in the current working directory"""
-    git_path = gitwrapper.detect_git();
+    git_path = gitwrapper.find_git_root();
     if git_path != None:
         raise UserErrorMessage("Already a git repository in »%s«" % git_path)
     git = gitwrapper.Git(os.getcwd())
@@ -106,14 +109,46 @@ def cmd_init(args):
     git.call_success("add", p.absolute_filepath())
     git.call_success("commit", "-m", "Initial commit");
 
+def parse_int_option(name, value):
+    try:
+        return int(value)
+    except ValueError:
+        raise UserErrorMessage("Invalid number »%s« for %s" % (value, name))
+
 def cmd_fetch(args):
-    """Usage: fetch [PATH…]
+    """Usage: fetch [--force] [--jobs=N] [--timeout=SECONDS] [--retries=N] [PATH…]
 
     Updates the given PATHs to the current upstream version, and creates them
     if necessary.
 
     If no PATH is given, then all configured paths will be fetched.
+
+    N packages are fetched in parallel (default: option fetch_jobs in
+    plaur.ini). Every git call is aborted after SECONDS seconds and a
+    failed package is retried up to N times (defaults: fetch_timeout and
+    fetch_retries). In the end, a summary of all packages is printed.
+
+    Unless --force is given or conditional_fetch is disabled in plaur.ini,
+    the remote HEAD of each package is compared with the local one first and
+    only the packages that changed upstream are pulled.
+
+    If mirror_url is set in plaur.ini, then the branches of all packages are
+    fetched from this mirror at once, and the packages are updated from the
+    local copy of the mirror. Packages missing in the mirror are fetched
+    directly.
     """
+    options = { }
+    force = False
+    while args and args[0].startswith('--'):
+        if args[0] == '--force':
+            force = True
+            args = args[1:]
+            continue
+        (name,_,value) = args[0][2:].partition('=')
+        if name not in ['jobs', 'timeout', 'retries'] or value == '':
+            raise UserErrorMessage("Unknown option »%s«" % args[0])
+        options[name] = parse_int_option(args[0], value)
+        args = args[1:]
     paths = args
     git = assert_plaur_git()
     packs = packageconfig.PackageConfig(git);
@@ -125,21 +160,75 @@ def cmd_fetch(args):
     else:
         # if no path is given, implicitly use all paths saved
         paths = packs.paths()
-    draw_progressbar = True
-    #pg = ProgressBar()
-    #pg.set(0.0)
-    def fetch_thing(current_p):
-        packs.fetch(current_p)
-
-    pool = ThreadPoolExecutor(10)
-    futures = [ (p, pool.submit(fetch_thing,(p))) for p in paths ]
-    for p,f in futures:
-        print("Waiting for {} to be fetched".format(p))
-        f.result()
-    #pg.set(1.0)
+    fetcher = plaur.fetcher.Fetcher(packs,
+        jobs = options.get('jobs', config.getint('fetch_jobs') or 1),
+        timeout = options.get('timeout', config.getint('fetch_timeout')),
+        retries = options.get('retries', config.getint('fetch_retries') or 0),
+        conditional = not force and config.getboolean('conditional_fetch'),
+        mirror = packs.mirror())
+    results = fetcher.run(paths)
+    fetch_journal(git).append(results)
+    fetcher.print_summary(results)
+    failed = [ r for r in results if r.status == 'failed' ]
+    if failed:
+        raise UserErrorMessage("Fetching %d packages failed" % len(failed))
+
+def fetch_journal(git):
+    return plaur.fetcher.FetchJournal(os.path.join(git.plaur_dir(), 'fetch-journal.jsonl'))
+
+def cmd_log(args):
+    """Usage: log [--changed-only] [--slowest=N]
+
+    Show what happened to each package in the last fetch run, as recorded in
+    the fetch journal in .git/plaur/fetch-journal.jsonl.
+
+    If --changed-only is given, then only packages that were cloned, updated
+    or failed are listed. If --slowest is given, then instead the N packages
+    with the highest average fetch duration over all recorded runs are shown.
+    """
+    changed_only = False
+    slowest = None
+    for a in args:
+        if a == '--changed-only':
+            changed_only = True
+        elif a.startswith('--slowest='):
+            slowest = parse_int_option('--slowest', a[len('--slowest='):])
+        else:
+            raise UserErrorMessage("Unknown option »%s«" % a)
+    git = assert_plaur_git()
+    runs = fetch_journal(git).runs()
+    if not runs:
+        print("No fetch runs recorded yet.")
+        return
+    hashlength = 10
+    if slowest is not None:
+        durations = { }
+        for _,records in runs:
+            for r in records:
+                durations.setdefault(r['path'], []).append(r['duration'])
+        averages = [ (sum(d) / len(d), len(d), p) for p,d in durations.items() ]
+        averages.sort(reverse=True)
+        print("Average fetch durations over %d runs:" % len(runs))
+        for avg,count,path in averages[0:slowest]:
+            print("  %-30s %6.2fs (%d runs)" % (path, avg, count))
+        return
+    (run,records) = runs[-1]
+    print("Fetch run of %s:" % run)
+    for r in sorted(records, key=lambda r: r['path']):
+        if changed_only and r['status'] == 'unchanged':
+            continue
+        line = "  %-30s %-9s" % (r['path'], r['status'])
+        if r['status'] == 'updated':
+            line += " %s..%s" % (r['old'][0:hashlength], r['new'][0:hashlength])
+        elif r['status'] == 'cloned':
+            line += " %s" % (r['new'] or '')[0:hashlength]
+        elif r['status'] == 'failed':
+            line += " %s" % r['error']
+        line += " (%.2fs)" % r['duration']
+        print(line)
 
 def cmd_add(args):
-    """Usage: add [--asdeps] PACKAGENAME [PATH]
+    """Usage: add [--asdeps] [--clone=STRATEGY] PACKAGENAME [PATH]
 
     Add a package with name PACKAGENAME and put it in the directory specified
     by PATH (either absolute or relative to the current working directory).
@@ -147,10 +236,23 @@ def cmd_add(args):
 
     If --asdeps is supplied, then the package will be marked as being a
     dependency for another package.
+
+    If --clone is supplied, then the package is cloned with the given
+    STRATEGY instead of the clone_strategy from plaur.ini: full, shallow
+    (only the latest commit) or blobless (file contents are downloaded on
+    demand). For diffs, missing history is fetched when needed.
     """
     asdeps = False
-    if (len(args) >= 1 and args[0] == '--asdeps'):
-        asdeps = True
+    clone = None
+    while len(args) >= 1 and args[0].startswith('--'):
+        if args[0] == '--asdeps':
+            asdeps = True
+        elif args[0].startswith('--clone='):
+            clone = args[0][len('--clone='):]
+            if clone not in P.clone_strategies:
+                raise UserErrorMessage("Invalid clone strategy »%s«" % clone)
+        else:
+            raise UserErrorMessage("Unknown option »%s«" % args[0])
         args = args[1:]
     if (len(args) < 1):
         raise UserErrorMessage("To few arguments")
@@ -160,7 +262,8 @@ def cmd_add(args):
     packs = packageconfig.PackageConfig(git)
     prefix = git.prefix_of_cwd()
     packs.read()
-    packs.add(prefix+path, "https://aur.archlinux.org/%s.git" % name, asdeps = asdeps)
+    packs.add(prefix+path, "https://aur.archlinux.org/%s.git" % name,
+              asdeps = asdeps, clone = clone)
     packs.write()
     packs.commit("Add " + prefix + path);
 
@@ -190,19 +293,40 @@ def cmd_diff(args):
         # if no path is given, implicitly use all paths saved
         paths = packs.paths()
         hide_if_unchanged = True
-    for fullpath in paths:
-        package = packs[fullpath]
-        last_verified = package.last_verified()
-        diff_string = package.git.call_success('diff', '--color=always', last_verified, 'HEAD')
-        if hide_if_unchanged and diff_string.lstrip() == '':
-            continue
-        output  = colored_header(package.path)
-        output += diff_string
-        output += "\n"
-        pager.stdin.write(output.encode("utf-8"))
-        pager.stdin.flush()
-    pager.stdin.close()
-    pager.wait()
+    try:
+        for fullpath in paths:
+            package = packs[fullpath]
+            last_verified = package.last_verified()
+            diff_args = [ last_verified, 'HEAD' ]
+            if hide_if_unchanged and last_verified == package.git.HEAD():
+                continue
+            package.ensure_history(last_verified)
+            if hide_if_unchanged:
+                _,_,status = package.git.call('diff', '--quiet', *diff_args)
+                if status == 0:
+                    continue
+            pager.stdin.write(colored_header(package.path).encode("utf-8"))
+            pager.stdin.flush()
+            # let git write into the pager directly
+            status = package.git.plain_call('diff', '--color=always', *diff_args,
+                                            stdout=pager.stdin)
+            if status == -signal.SIGPIPE or pager.poll() is not None:
+                # the user quit the pager
+                break
+            if status != 0:
+                raise UserErrorMessage("git diff failed for %s with status %d"
+                                       % (package.path, status))
+            pager.stdin.write(b"\n")
+            pager.stdin.flush()
+    except BrokenPipeError:
+        # the user quit the pager
+        pass
+    finally:
+        try:
+            pager.stdin.close()
+        except BrokenPipeError:
+            pass
+        pager.wait()
 
 def cmd_verify(args):
     """Usage: verify [PATH…]
@@ -237,8 +361,11 @@ def cmd_verify(args):
             print("%s up to date (on %s)." % (package.path, last_verified))
             continue
         if show_diffs:
-            print(colored_header("Changes in " + package.path))
-            print(package.git.call_success('diff', '--color=always', last_verified, 'HEAD'))
+            package.ensure_history(last_verified)
+            print(colored_header("Changes in " + package.path), flush=True)
+            for chunk in package.git.stream('diff', '--color=always', last_verified, 'HEAD'):
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.flush()
         if not user_confirm or ask("Verify %s to %s?" % (package.path, package_HEAD),default_yes=False):
             print ("Verifying %s to %s." % (package.path, package_HEAD))
             package.settings['verified'] = package_HEAD
@@ -246,15 +373,29 @@ def cmd_verify(args):
             packs.commit("Verify " + package.path)
 
 def cmd_build(args):
-    """Usage: build [PATH…]
+    """Usage: build [--jobs=N] [PATH…]
 
     Execute makepkg in those of the given PATHs, that are verified, and skip
-    the other (unverified) PATHs. After a successful build, the new packages
-    are installed via pacman.
+    the other (unverified) PATHs. The built packages are installed via
+    pacman in few transactions: packages needed by other builds are
+    installed together right before these start, the others at the end.
+
+    Up to N packages are built in parallel (default: option build_jobs in
+    plaur.ini). A package is built as soon as all packages it depends on are
+    built and installed. If a build fails, only the packages depending on it
+    are skipped. The CPU cores are distributed among the parallel builds via
+    MAKEFLAGS, see the options build_cpus and build_jobserver.
     """
-    install = False
-    if (len(args) >= 1 and args[0] == '--install'):
-        install = True
+    jobs = None
+    while len(args) >= 1 and args[0].startswith('--'):
+        if args[0] == '--install':
+            # installing is the default, the option is only accepted for
+            # compatibility
+            pass
+        elif args[0].startswith('--jobs='):
+            jobs = parse_int_option('--jobs', args[0][len('--jobs='):])
+        else:
+            raise UserErrorMessage("Unknown option »%s«" % args[0])
         args = args[1:]
     git = assert_plaur_git()
     packs = packageconfig.PackageConfig(git)
@@ -266,27 +407,31 @@ def cmd_build(args):
         paths = [ prefix + p for p in paths ]
     else:
         paths = packs.paths()
-        install = True
+    if jobs is None:
+        jobs = config.getint('build_jobs') or 1
+    # fail before building if the install_backend is invalid
+    plaur.installer.backend(config['install_backend'])
     # reorder paths according to dependencies
-    (provides,dependencies) = packs.compute_depgraph(paths, provide_guessing = True)
-    paths = packageconfig.PackageConfig.depsort(provides,dependencies)
+    (dependencies,provides) = packs.compute_depgraph(paths, provide_guessing = True)
+    paths = packageconfig.PackageConfig.depsort(dependencies, provides,
+                                                packs.breakable_edges(paths))
     print("Building the packages: " + ' '.join(paths))
-    for fullpath in paths:
-        package = packs[fullpath]
-        try:
-            print(":: " + package.path)
-            print("  fetching sources...")
-            package.fetch_sources()
-            if not package.is_built():
-                package.build()
-            else:
-                print("  Built packages up to date")
-            if package.is_built() and package.uninstalled_packages():
-                P.Package.install([package])
-            else:
-                print("  Installed packages up to date")
-        except P.PackageUnverified as e:
-            print(":: Skipping unverified %s" % e.path)
+    budget = None
+    cpus = config.getint('build_cpus')
+    if cpus is not None or jobs > 1:
+        if config.getboolean('build_jobserver'):
+            budget = plaur.scheduler.Jobserver(cpus)
+        else:
+            budget = plaur.scheduler.CpuBudget(cpus)
+    scheduler = plaur.scheduler.BuildScheduler(packs, dependencies, provides,
+                                               jobs=jobs, budget=budget)
+    try:
+        outcome = scheduler.run(paths)
+    finally:
+        if budget is not None:
+            budget.close()
+        packs.build_state().save()
+    scheduler.print_summary(outcome)
 
 def cmd_git(args):
     """Usage: git [ARGS…]
@@ -404,6 +549,20 @@ Github page: http://github.com/t-wissmann/plaur
 """)
 
 def cmd_status(args):
+    """Usage: status [--installed] [PATH…]
+
+    For the given PATHs (or all paths if none is given), show the last
+    verified commit and the checked out commit. With --installed, also
+    show the installed versions of the packages, or »?« if the .SRCINFO
+    of the verified commit is not available.
+    """
+    show_installed = False
+    while len(args) >= 1 and args[0].startswith('--'):
+        if args[0] == '--installed':
+            show_installed = True
+        else:
+            raise UserErrorMessage("Unknown option »%s«" % args[0])
+        args = args[1:]
     class Cell:
         def __init__(self,text,color=None):
             self.text = text
@@ -451,27 +610,49 @@ def cmd_status(args):
         paths = packs.paths()
     table = Table()
     hashlength = 10 # tells how short the git commit hashes are cropped
+    if show_installed:
+        packs.preload_srcinfos(paths)
     for fullpath in paths:
         package = packs[fullpath]
         last_verified = package.last_verified()
         lvcolor = '42;30'
         headcolor = None
+        head = ''
         if package.git.exists():
-            head = package.git.HEAD()
+            try:
+                head = package.git.HEAD()
+            except UserErrorMessage:
+                # e.g. an empty repository
+                pass
             if head == last_verified:
                 headcolor = lvcolor
             else:
                 headcolor = '41;1;37'
-        else:
-            head = ''
         r = [
             Cell(fullpath),
             Cell(last_verified[0:hashlength],color=lvcolor),
             Cell(head[0:hashlength],color=headcolor),
         ]
+        if show_installed:
+            r.append(Cell(installed_column(package)))
         table.add_row(r)
+    if show_installed:
+        packs.save_srcinfo_cache()
     print(table,end="")
 
+# the text of the installed column of status for the given package
+def installed_column(package):
+    try:
+        versions = package.installed_versions()
+    except (FileNotFoundError, UserErrorMessage) as e:
+        debug("Can not tell the installed version of %s: %s" % (package.path, e))
+        return '?'
+    installed = sorted(set(v for v in versions.values() if v is not None))
+    text = ','.join(installed) if installed else '-'
+    if None in versions.values() and installed:
+        text += ' (partially)'
+    return text
+
 def cmd_depadd(args):
     """Usage: depadd [PATH…]
 
@@ -492,7 +673,7 @@ def cmd_depadd(args):
     (dependencies,provides) = packs.compute_depgraph(paths,provide_guessing=True)
     unresolved_deps = [ ]
     for needed,by in dependencies.items():
-        if not needed in provides:
+        if not provides.get(needed):
             unresolved_deps.append(needed)
     print("unresolved: %s" % ' '.join(unresolved_deps))
     res = alpm_depcheck(unresolved_deps)
@@ -507,8 +688,12 @@ def cmd_depadd(args):
     if res.missing and ask ("Add unresolved packages?"):
         packs.read()
         for p in res.missing:
-            path = os.path.join(prefix, p)
-            url = "https://aur.archlinux.org/%s.git" % p
+            name = split_dependency(p)[0]
+            path = os.path.join(prefix, name)
+            if path in packs.paths():
+                print("%s is in the plaur repository, but does not satisfy %s" % (path, p))
+                continue
+            url = "https://aur.archlinux.org/%s.git" % name
             packs.add(path, url, asdeps = True)
             packs.write()
             msg = ("Add dependency %s\n\n"
@@ -533,6 +718,77 @@ def cmd_cat_srcinfo(args):
         srcinfofile.load()
         print(srcinfofile, end="")
 
+def cmd_check_refs(args):
+    """
+    Usage: check_refs [PATH…]
+
+    This command exists solely for debugging purposes:
+
+    For the given PATHs (or all paths if none are given), compare the HEAD
+    that plaur resolves by reading the git directory with the output of
+    git rev-parse HEAD and report every difference.
+    """
+    git = assert_plaur_git()
+    packs = packageconfig.PackageConfig(git)
+    packs.read()
+    paths = args
+    if paths:
+        prefix = git.prefix_of_cwd()
+        paths = [ prefix + p for p in paths ]
+    else:
+        paths = packs.paths()
+    repos = [ (p, packs[p].git) for p in paths if packs[p].git.exists() ]
+    repos.insert(0, ('.', git))
+    mismatches = 0
+    for path,repo in repos:
+        native = repo.refs.resolve('HEAD')
+        out,_,status = repo.call('rev-parse', '--verify', '-q', 'HEAD')
+        expected = out.strip() if status == 0 else None
+        if native is None:
+            print("%s: falls back to git (%s)" % (path, expected))
+        elif native != expected:
+            print("%s: MISMATCH: resolved %s, but git says %s" % (path, native, expected))
+            mismatches += 1
+    print("Checked %d repositories, %d mismatches." % (len(repos), mismatches))
+    if mismatches:
+        raise UserErrorMessage("Native ref resolution disagrees with git")
+
+def cmd_bench_srcinfo(args):
+    """
+    Usage: bench_srcinfo [--rounds=N] [FILES…]
+
+    This command exists solely for debugging purposes:
+
+    Parse each of the given FILES of the .SRCINFO format N times (default: 100)
+    and query the dependencies and package names of it. Print the average
+    durations per file and the totals.
+    """
+    rounds = 100
+    if args and args[0].startswith('--rounds='):
+        rounds = parse_int_option('--rounds', args[0][len('--rounds='):])
+        args = args[1:]
+    total_parse = 0.0
+    total_query = 0.0
+    for f in args:
+        with open(f) as fh:
+            lines = fh.readlines()
+        srcinfofile = plaur.srcinfo.SRCINFO(f)
+        start = time.perf_counter()
+        for _ in range(0, rounds):
+            srcinfofile.parse(lines)
+        parsed = time.perf_counter()
+        for _ in range(0, rounds):
+            for key in ['depends', 'makedepends', 'checkdepends', 'provides']:
+                srcinfofile.query_any(key)
+            srcinfofile.package_names()
+        queried = time.perf_counter()
+        total_parse += parsed - start
+        total_query += queried - parsed
+        print("%-40s parse: %7.1fµs  query: %7.1fµs" % (f,
+              1e6 * (parsed - start) / rounds, 1e6 * (queried - parsed) / rounds))
+    print("%d files, %d rounds: parse %.3fs, query %.3fs in total"
+          % (len(args), rounds, total_parse, total_query))
+
 def cmd_cat_config(args):
     """
     Usage: cat_config
@@ -546,33 +802,75 @@ def cmd_cat_config(args):
 
 def cmd_why(args):
     """
-    Usage: why [PACKAGES…]
+    Usage: why [--tree|--reverse] [PACKAGES…]
 
     For the given PACKAGES, why they are in the plaur repository. That is, tell
     whether it was added explicitly or as a dependency, and tell by which other
     packages it is needed.
+
+    With --tree, show the full chain of packages needing the PACKAGES, up to
+    the explicitly added ones. With --reverse, show the tree of packages that
+    the PACKAGES need.
     """
+    mode = None
+    if args and args[0] in ['--tree', '--reverse']:
+        mode = args[0]
+        args = args[1:]
     git = assert_plaur_git()
     packs = packageconfig.PackageConfig(git)
     packs.read()
     (deps,provs) = packs.compute_depgraph(packs.paths(), provide_guessing=True)
+    index = plaur.depgraph.PathIndex(deps, provs)
     paths = args
     if paths:
         prefix = git.prefix_of_cwd()
         paths = [ os.path.join(prefix, p) for p in paths ]
     else:
         paths = packs.paths()
+    def reason(path):
+        asdeps = packs[path].settings.getboolean('asdeps', fallback=False)
+        return "dependency" if asdeps else "explicit"
+    if mode is not None:
+        if mode == '--tree':
+            (edges, verb) = (index.dependents, "needed by")
+        else:
+            (edges, verb) = (index.providers, "needs")
+        expanded = set()
+        for path in paths:
+            print("%s (%s)" % (path, reason(path)))
+            print_why_tree(path, edges, verb, reason, [ path ], expanded)
+        return
     for package in [ packs[p] for p in paths ]:
         if package.settings.getboolean('asdeps', fallback=False):
             print("%s was added as a dependency." % package.path)
         else:
             print("%s was added explicitly." % package.path)
-        for name,provided_by in provs.items():
-            if package.path in provided_by:
-                msg = "  %s required by: " % name
-                l = deps.get(name, [])
-                msg += ' '.join(l) if l else "nothing else"
-                print(msg)
+        # group dependencies with version constraints by the package name
+        required_by = { }
+        for key in index.provided.get(package.path, []):
+            (name, op, version) = split_dependency(key)
+            l = required_by.setdefault(name, [])
+            for p in index.required_by[package.path][key]:
+                l.append(p if op is None else "%s (%s%s%s)" % (p, name, op, version))
+        for name,l in required_by.items():
+            msg = "  %s required by: " % name
+            msg += ' '.join(l) if l else "nothing else"
+            print(msg)
+
+def print_why_tree(path, edges, verb, reason, ancestors, expanded):
+    # print the tree of paths reachable from path via edges. Subtrees that
+    # were printed already are not repeated.
+    expanded.add(path)
+    indent = '  ' * len(ancestors)
+    for name,next_path in sorted(edges(path), key=lambda e: (e[1], e[0])):
+        line = "%s%s %s (via %s, %s)" % (indent, verb, next_path, name, reason(next_path))
+        if next_path in ancestors:
+            print(line + " [cycle]")
+        elif next_path in expanded:
+            print(line + " [see above]")
+        else:
+            print(line)
+            print_why_tree(next_path, edges, verb, reason, ancestors + [ next_path ], expanded)
 
 def cmd_rm(args):
     """Usage: rm [PACKAGES…]
@@ -599,6 +897,51 @@ def cmd_rm(args):
     packs.write()
     packs.commit("Remove " + prefix + path);
 
+def objects_size(git):
+    # the disk usage of the object directory of git in bytes
+    total = 0
+    for root, dirs, files in os.walk(os.path.join(git.git_dir, 'objects')):
+        for f in files:
+            total += os.lstat(os.path.join(root, f)).st_size
+    return total
+
+def cmd_share(args):
+    """Usage: share [PATH…]
+
+    Move the git objects of the given PATHs (or of all paths if none is given)
+    into the object store shared by all packages, such that objects that
+    occur in multiple packages are stored only once. This requires the option
+    shared_objects in plaur.ini. Afterwards, the package repositories
+    depend on the store in .git/plaur/objects.git, so it must not be deleted.
+    """
+    git = assert_plaur_git()
+    packs = packageconfig.PackageConfig(git)
+    packs.read()
+    store = packs.object_store()
+    if store is None:
+        raise UserErrorMessage("Sharing objects is disabled. Set shared_objects = yes in %s"
+                               % plaur.config.plaur_ini)
+    paths = args
+    if paths:
+        prefix = git.prefix_of_cwd()
+        paths = [ prefix + p for p in paths ]
+    else:
+        paths = packs.paths()
+    before = 0
+    after = 0
+    store.ensure()
+    store_before = objects_size(store.git)
+    for package in [ packs[p] for p in paths ]:
+        if not package.git.exists():
+            continue
+        print(":: " + package.path)
+        before += objects_size(package.git)
+        if not package.share_objects():
+            print("   skipped, because it is a shallow or partial clone")
+        after += objects_size(package.git)
+    after += objects_size(store.git) - store_before
+    print("Objects of the packages took %d KiB and take %d KiB now." % (before // 1024, after // 1024))
+
 def cmd_mkexclude(args):
     """Usage: mkexclude
 
@@ -617,6 +960,7 @@ commands = [
     [ "init",    Command(cmd_init, "Initalize the present directory")],
     [ "add",     Command(cmd_add, "Add a new package")],
     [ "fetch",   Command(cmd_fetch, "Update or create a PKGBUILD from upstream")],
+    [ "log",     Command(cmd_log, "Show the results of the last fetch")],
     [ "diff",    Command(cmd_diff, "Show differences since last verification")],
     [ "verify",  Command(cmd_verify, "Verify a pkgbuild")],
     [ "build",   Command(cmd_build, "Build the specified packages")],
@@ -627,9 +971,12 @@ commands = [
     [ "depadd",  Command(cmd_depadd, "Add dependencies for the given packages")],
     [ "cat_srcinfo",  Command(cmd_cat_srcinfo, "Read and print the given .SRCINFO files")],
     [ "cat_config",  Command(cmd_cat_config, "Read and print the plaur.ini")],
+    [ "bench_srcinfo",  Command(cmd_bench_srcinfo, "Measure .SRCINFO parsing and queries")],
+    [ "check_refs",  Command(cmd_check_refs, "Compare native ref resolution with git")],
     [ "why",  Command(cmd_why, "Tell why a package is in the plaur repository")],
     [ "rm",  Command(cmd_rm, "Remove a package")],
     [ "mkexclude",  Command(cmd_mkexclude, "Update .git/info/exclude")],
+    [ "share",  Command(cmd_share, "Move package objects to a shared store")],
 ]
 
 
@@ -1,15 +1,32 @@
 import subprocess
 import time
 import os
+import re
+import shutil
 
 import pyalpm
 
+import plaur
+import plaur.installer
 
 from plaur import gitwrapper
 from plaur import srcinfo
 
 from plaur.utils import *
 
+# the id of the empty tree, which serves as the verified version of packages
+# that have never been verified
+empty_tree = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+# the definition of a pkgver() function in a PKGBUILD
+pkgver_function = re.compile('^\\s*(function\\s+pkgver\\b|pkgver\\s*\\(\\s*\\))', re.MULTILINE)
+
+# the git clone arguments of the available clone strategies
+clone_strategies = {
+    'full': [ ],
+    'shallow': [ '--depth=1' ],
+    'blobless': [ '--filter=blob:none' ],
+}
 
 class Package:
     # Package represents a concrete section of a PackageConfig
@@ -25,14 +42,135 @@ class Package:
         self.srcinfo = srcinfo.SRCINFO(self.fullpath + '/.SRCINFO')
         self.vcs_pkgver_cache = None
 
-    def fetch(self):
+    def remote_head(self, timeout=None):
+        """Ask the remote for its HEAD without fetching any objects"""
+        out = self.git.call_success("ls-remote", "origin", "HEAD", timeout=timeout)
+        fields = out.split()
+        return fields[0] if fields else None
+
+    def mirror_branch(self):
+        """Return the name of the branch of this package in an AUR mirror"""
+        name = os.path.basename(self.settings['url'].rstrip('/'))
+        if name.endswith('.git'):
+            name = name[:-len('.git')]
+        return name
+
+    def fetch(self, timeout=None, conditional=True, mirror=None):
+        """Clone or fast-forward the package repository. Return 'cloned',
+        'unchanged' or 'updated'. Git calls taking longer than timeout seconds
+        are aborted. If conditional is set, then the remote HEAD is compared
+        with the local HEAD first and nothing is fetched if they agree.
+        If a Mirror is given, the package is updated from its branch there."""
+        if mirror is not None:
+            return self.fetch_from_mirror(mirror, timeout=timeout)
         if not os.path.isdir(self.fullpath):
             url = self.settings['url']
+            clone = ["git", "clone", "--quiet"] + clone_strategies[self.clone_strategy()]
+            store = self.pacconf.object_store()
+            # shallow and partial clones are never imported into the store,
+            # so they must not borrow objects from there either
+            if store is not None and self.clone_strategy() == 'full':
+                store.ensure()
+                clone += [ "--reference-if-able", store.path ]
             # FIXME: package_git.call_success("clone", url) somehow ignores the --git-dir
-            if 0 != subprocess.call(["git", "clone", url, self.fullpath]):
-                raise UserErrorMessage("git clone failed for %s" % self.path)
+            try:
+                proc = subprocess.run(clone + [url, self.fullpath],
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE,
+                                      timeout=timeout)
+                status = proc.returncode
+                err = proc.stderr.decode("utf-8").strip()
+            except subprocess.TimeoutExpired:
+                status = None
+                err = "timed out after %s seconds" % timeout
+            if status != 0:
+                # do not leave a half-done clone behind
+                shutil.rmtree(self.fullpath, ignore_errors=True)
+                raise UserErrorMessage("git clone failed for %s: %s" % (self.path, err))
+            self.share_objects()
+            return 'cloned'
         else:
-            self.git.call_success("pull", "--ff-only")
+            old_head = self.git.HEAD()
+            if conditional and self.remote_head(timeout=timeout) == old_head:
+                return 'unchanged'
+            self.git.call_success("pull", "--ff-only", "--quiet", timeout=timeout)
+            if self.git.HEAD() == old_head:
+                return 'unchanged'
+            self.share_objects()
+            return 'updated'
+
+    def fetch_from_mirror(self, mirror, timeout=None):
+        """Clone or fast-forward the package from its branch in the Mirror"""
+        branch = mirror.head(self.mirror_branch())
+        if branch is None:
+            raise UserErrorMessage("Branch %s does not exist in the mirror"
+                                   % self.mirror_branch())
+        refspec = '+%s:refs/remotes/origin/master' % mirror.ref(self.mirror_branch())
+        if not os.path.isdir(self.fullpath):
+            try:
+                os.makedirs(self.fullpath)
+                self.git.call_success('init', '--quiet', timeout=timeout)
+                self.git.call_success('remote', 'add', 'origin', self.settings['url'])
+                self.git.call_success('fetch', '--quiet', '--no-tags', mirror.path,
+                                      refspec, timeout=timeout)
+                self.git.call_success('checkout', '--quiet', '-b', 'master',
+                                      '--track', 'origin/master', timeout=timeout)
+            except:
+                # do not leave a half-done clone behind
+                shutil.rmtree(self.fullpath, ignore_errors=True)
+                raise
+            self.share_objects()
+            return 'cloned'
+        old_head = self.git.HEAD()
+        if branch == old_head:
+            return 'unchanged'
+        self.git.call_success('fetch', '--quiet', '--no-tags', mirror.path, refspec,
+                              timeout=timeout)
+        self.git.call_success('merge', '--ff-only', '--quiet', 'refs/remotes/origin/master',
+                              timeout=timeout)
+        if self.git.HEAD() == old_head:
+            return 'unchanged'
+        self.share_objects()
+        return 'updated'
+
+    def share_objects(self):
+        """If enabled, move the objects of the package to the shared store.
+        Return whether the package borrows its objects from there."""
+        store = self.pacconf.object_store()
+        if store is None:
+            return False
+        verified = self.settings['verified']
+        if verified == '' or self.git.batch_check().lookup(verified + '^{commit}') is None:
+            verified = None
+        if store.import_repo(self.path, self.git, verified=verified):
+            return True
+        debug("Not sharing the objects of the shallow or partial clone %s" % self.path)
+        return False
+
+    def clone_strategy(self):
+        """Return how the package is cloned: 'full', 'shallow' or 'blobless'"""
+        strategy = self.settings.get('clone', '')
+        if strategy == '':
+            strategy = plaur.main.config['clone_strategy']
+        if strategy not in clone_strategies:
+            raise UserErrorMessage("Invalid clone strategy »%s« for %s" % (strategy, self.path))
+        return strategy
+
+    def ensure_history(self, commit):
+        """In a shallow clone, deepen the history until commit is available"""
+        if commit == empty_tree or not self.git.is_shallow():
+            return
+        depth = 16
+        while self.git.batch_check().lookup(commit + '^{commit}') is None:
+            if not self.git.is_shallow():
+                raise UserErrorMessage("Commit %s does not exist in %s" % (commit, self.path))
+            if depth > 1024:
+                print("Fetching the entire history of %s" % self.path)
+                self.git.call_success("fetch", "--quiet", "--unshallow")
+            else:
+                debug("Deepening %s by %d commits" % (self.path, depth))
+                self.git.call_success("fetch", "--quiet", "--deepen=%d" % depth)
+                depth *= 4
 
     def fetch_sources(self):
         """Fetch sources needed to build the package"""
@@ -47,7 +185,7 @@ class Package:
     def last_verified(self):
         last_verified = self.settings['verified']
         if last_verified == '':
-            last_verified = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+            last_verified = empty_tree
         return last_verified
 
     def assert_verified(self):
@@ -59,26 +197,68 @@ class Package:
     def is_verified(self):
         return self.last_verified() == self.git.HEAD()
 
-    def dependencies(self):
-        """Return a traversable of package names this package depends on"""
-        self.srcinfo.load()
-        deps = self.srcinfo.query_any('makedepends')
-        deps += self.srcinfo.query_any('depends')
-        deps += self.srcinfo.query_any('checkdepends')
-        return srcinfo.SRCINFO.drop_version_constraints(deps)
-
-    def provides(self):
-        """Return a traversable of package names this package provides on"""
-        self.srcinfo.load()
-        provs = list(self.srcinfo.packages())
-        provs += self.srcinfo.query_any('provides')
-        return srcinfo.SRCINFO.drop_version_constraints(provs)
+    def load_srcinfo(self, fetch=True):
+        """Load the .SRCINFO (via the cache of the PackageConfig) and return it.
+        If the package was verified, then the .SRCINFO is read from the
+        verified commit, regardless of the checked out version. Otherwise,
+        it is read from the working tree. Raises FileNotFoundError if there
+        is no .SRCINFO. Unless fetch is False, a shallow clone is deepened
+        if the verified commit is missing."""
+        if self.srcinfo.loaded_once:
+            return self.srcinfo
+        cache = self.pacconf.srcinfo_cache()
+        verified = self.settings['verified']
+        if verified == '':
+            cache.load(self.srcinfo)
+        elif cache.load_key(self.srcinfo, self.generated_srcinfo_key()):
+            pass
+        elif not cache.load_commit(self.srcinfo, self.git, verified):
+            if not self.git.exists():
+                raise FileNotFoundError("%s does not exist" % self.path)
+            if not fetch:
+                raise FileNotFoundError("The verified commit %s of %s is not available"
+                                        % (verified, self.path))
+            # the verified commit may be missing in a shallow clone
+            self.ensure_history(verified)
+            if not cache.load_commit(self.srcinfo, self.git, verified):
+                raise FileNotFoundError("No .SRCINFO in the verified commit %s of %s"
+                                        % (verified, self.path))
+        self.srcinfo.loaded_once = True
+        return self.srcinfo
+
+    def generated_srcinfo_key(self):
+        return 'generated:%s' % self.last_verified()
+
+    def generate_srcinfo(self):
+        """If verified, generate the .SRCINFO via makepkg --printsrcinfo and
+        add it to the cache, keyed by the verified commit"""
+        self.assert_verified()
+        proc = subprocess.run(['makepkg', '--printsrcinfo'], cwd=self.fullpath,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise UserErrorMessage("makepkg --printsrcinfo failed for %s: %s"
+                                   % (self.path, proc.stderr.decode("utf-8").strip()))
+        self.srcinfo.parse(proc.stdout.decode("utf-8").splitlines())
+        self.pacconf.srcinfo_cache().store(self.generated_srcinfo_key(), self.srcinfo)
+        self.srcinfo.loaded_once = True
+
+    def defines_pkgver(self):
+        """Tell whether the PKGBUILD defines a pkgver() function"""
+        try:
+            with open(os.path.join(self.fullpath, 'PKGBUILD')) as fh:
+                return pkgver_function.search(fh.read()) is not None
+        except FileNotFoundError:
+            return False
 
     def vcs_pkgver(self):
         """If verified, return the VCS version using pkgver() in PKGBUILD"""
         self.assert_verified()
         if self.vcs_pkgver_cache != None:
             return self.vcs_pkgver_cache 
+        if not self.defines_pkgver():
+            # no need to run bash
+            self.vcs_pkgver_cache = ""
+            return self.vcs_pkgver_cache
         command = """
         pkgver() { true; } ;
         srcdir='src/' ;
@@ -93,8 +273,11 @@ class Package:
 
     def packagelist(self):
         """If .SRCINFO exists, return a list of packages"""
-        self.srcinfo.load()
+        self.load_srcinfo()
         package_names = self.srcinfo.package_names()
+        pkgext = makepkg_pkgext()
+        for p in package_names:
+            p.suffix = pkgext
         if self.is_verified():
             new_version = self.vcs_pkgver()
             if new_version != "":
@@ -102,28 +285,52 @@ class Package:
                     p.ver = new_version
         return package_names
 
+    def build_state_key(self):
+        return '%s:%s:%s' % (self.last_verified(), self.vcs_pkgver(), makepkg_pkgext())
+
     def is_built(self):
-        """Tell whether all packages created by that package exist """
-        for f in self.packagelist():
-            f = os.path.join(self.fullpath, str(f))
-            if not os.path.isfile(f):
+        """Tell whether all packages created by that package exist. For
+        verified packages, this is remembered in the BuildState of the
+        PackageConfig"""
+        state = None
+        if self.is_verified():
+            state = self.pacconf.build_state()
+            key = self.build_state_key()
+            if state.is_built(self.path, key, self.fullpath):
+                return True
+        filenames = [ str(f) for f in self.packagelist() ]
+        for f in filenames:
+            if not os.path.isfile(os.path.join(self.fullpath, f)):
                 return False
+        if state is not None:
+            state.set_built(self.path, key, self.fullpath, filenames)
         return True
 
     def uninstalled_packages(self):
         """Tell which packages by this package are not installed"""
-        alpm = ALPM.get()
-        local_db = alpm.get_localdb()
+        local = ALPM.local_snapshot()
         uninstalled = [ ]
         for f in self.packagelist():
-            dep = f.name + '=' + f.ver + '-' + f.rel
-            if pyalpm.find_satisfier(local_db.pkgcache, dep):
+            installed = local.version(f.name)
+            if installed is not None and pyalpm.vercmp(installed, f.version()) == 0:
                 continue
             else:
                 uninstalled.append(f)
         return uninstalled
 
-    def build(self):
+    def installed_versions(self):
+        """Return a dictionary mapping the names of the packages of this
+        package to their installed version, or None if not installed. Never
+        fetches; raises FileNotFoundError or UserErrorMessage if the
+        .SRCINFO is not available"""
+        names = self.load_srcinfo(fetch=False).packages()
+        local = ALPM.local_snapshot()
+        return { name: local.version(name) for name in names }
+
+    def build(self, env=None, pass_fds=()):
+        """Run makepkg and return whether it succeeded. The variables in env
+        are added to the environment of makepkg and the file descriptors in
+        pass_fds are inherited by it."""
         self.assert_verified()
         print("  Running makepkg in %s" % self.path)
         makepkg = ['makepkg']
@@ -131,18 +338,26 @@ class Package:
         logfile = 'build-%s.log' % time.strftime('%Y-%m-%d-%H-%M')
         logfile = os.path.join(self.fullpath, logfile)
         with open(logfile, "w") as outfile:
-            proc = subprocess.Popen(makepkg, cwd=self.fullpath, stdout=outfile, stderr=outfile)
+            proc = subprocess.Popen(makepkg, cwd=self.fullpath, stdout=outfile, stderr=outfile,
+                                    env=dict(os.environ, **(env or { })),
+                                    pass_fds=pass_fds)
         print("  For live logging, type:\n  tail -f %s" % logfile)
         status = proc.wait()
         if status != 0:
-            print("  makepkg failed with exit status %d:" % status)
+            msg = "  makepkg failed in %s with exit status %d:" % (self.path, status)
             with open(logfile) as f:
                 lines = f.read().strip('\n').split('\n')
                 for l in lines[-10:]:
-                    print("    " + l)
+                    msg += "\n    " + l
+            # print at once, such that parallel builds do not interleave
+            print(msg)
+        return status == 0
 
     @staticmethod
     def install(packagelist):
+        """Install the packages of all the given Package objects in one
+        transaction of the install_backend and return whether this
+        succeeded"""
         asexplicit = [ ]
         asdeps = [ ]
         files = [ ]
@@ -155,20 +370,14 @@ class Package:
                     asexplicit.append(f.name)
         if not files:
             # nothing to install
-            return
-        pacman = [ 'sudo', 'pacman', '-U', '--noconfirm' ]
-        pacman += files
-        proc = subprocess.Popen(pacman)
-        status = proc.wait()
-        if asexplicit:
-            pacman = [ 'sudo', 'pacman', '-D', '--asexplicit' ]
-            pacman += asexplicit
-            proc = subprocess.Popen(pacman)
-            status = proc.wait()
-        if asdeps:
-            pacman = [ 'sudo', 'pacman', '-D', '--asdeps' ]
-            pacman += asdeps
-            proc = subprocess.Popen(pacman)
-            status = proc.wait()
+            return True
+        installer = plaur.installer.backend(plaur.main.config['install_backend'])
+        if not installer.install(files, asdeps, asexplicit):
+            return False
+        for package in packagelist:
+            for f in package.packagelist():
+                provides = package.srcinfo.query_pkgname(f.name, 'provides')
+                ALPM.installed(InstalledPackage(f.name, f.version(), provides))
+        return True
 
 
@@ -1,9 +1,15 @@
 # vim: et ts=4 sw=4
 
+import collections
 import configparser
 import os
-import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import plaur
+import plaur.gitwrapper
+import plaur.srcinfo
+import plaur.depgraph
+import plaur.buildstate
 
 from plaur.utils import *
 
@@ -14,14 +20,23 @@ class PackageConfig:
         self.config = configparser.ConfigParser()
         self.git = git
         self.package_objects = {}
+        self.shared_store = None
+        self.srcinfo_parse_cache = None
+        self.dependency_graph = None
+        self.build_state_record = None
+        # guards the lazy creation of the objects above, which also happens
+        # in the threads of parallel fetches and builds
+        self.lock = threading.Lock()
 
-    def add(self, path, url, asdeps=False):
+    def add(self, path, url, asdeps=False, clone=None):
         # TODO: check that path is prefix-free to all the other paths
         self.config[path] = {
             'url' : url,
             'verified' : "",
             'asdeps' : asdeps,
         }
+        if clone is not None:
+            self.config[path]['clone'] = clone
 
     def rm(self, path):
         if not path in self.config:
@@ -54,8 +69,75 @@ class PackageConfig:
             self.package_objects[path] = obj
             return obj
 
-    def fetch(self, path):
-        self.get_package(path).fetch()
+    # return the SRCINFOCache of this plaur repository
+    def srcinfo_cache(self):
+        with self.lock:
+            if self.srcinfo_parse_cache is None:
+                filename = os.path.join(self.git.plaur_dir(), 'srcinfo-cache.json')
+                self.srcinfo_parse_cache = plaur.srcinfo.SRCINFOCache(filename)
+            return self.srcinfo_parse_cache
+
+    # the maximum number of package repositories whose objects are read by
+    # a single cat-file process in preload_srcinfos()
+    preload_chunk = 256
+
+    # read the .SRCINFO of the verified commits of the given paths into the
+    # SRCINFOCache, such that load_srcinfo() finds them there. Instead of
+    # one cat-file process per package, a single process of the plaur
+    # repository reads them, borrowing the objects of up to preload_chunk
+    # packages at once as alternates.
+    def preload_srcinfos(self, paths):
+        cache = self.srcinfo_cache()
+        todo = [ ]
+        for path in paths:
+            package = self[path]
+            verified = package.settings['verified']
+            objects = os.path.join(package.git.git_dir, 'objects')
+            if verified == '' or package.srcinfo.loaded_once \
+                    or cache.contains(plaur.srcinfo.SRCINFOCache.commit_key(verified)):
+                continue
+            # alternates are separated by colons
+            if ':' in objects or not os.path.isdir(objects):
+                continue
+            todo.append((verified, objects))
+        for i in range(0, len(todo), PackageConfig.preload_chunk):
+            chunk = todo[i:i + PackageConfig.preload_chunk]
+            batch = plaur.gitwrapper.BatchCheck(self.git, contents=True,
+                                                alternates=[ o for _,o in chunk ])
+            try:
+                cache.load_commits(batch, [ c for c,_ in chunk ])
+            finally:
+                batch.close()
+
+    # save the SRCINFOCache, dropping the entries of commits that are no
+    # longer verified
+    def save_srcinfo_cache(self):
+        cache = self.srcinfo_cache()
+        cache.prune_commits({ self.config[p]['verified'] for p in self.paths() })
+        cache.save()
+
+    # return the ObjectStore shared by all package repositories, or None if
+    # sharing objects is disabled in the plaur.ini
+    def object_store(self):
+        if not plaur.main.config.getboolean('shared_objects'):
+            return None
+        with self.lock:
+            if self.shared_store is None:
+                path = os.path.join(self.git.plaur_dir(), 'objects.git')
+                self.shared_store = plaur.gitwrapper.ObjectStore(path)
+            return self.shared_store
+
+    # return the Mirror configured in the plaur.ini, or None
+    def mirror(self):
+        url = plaur.main.config['mirror_url']
+        if url is None or url == '':
+            return None
+        path = os.path.join(self.git.plaur_dir(), 'mirror.git')
+        return plaur.gitwrapper.Mirror(path, url)
+
+    def fetch(self, path, timeout=None, conditional=True, mirror=None):
+        return self.get_package(path).fetch(timeout=timeout, conditional=conditional,
+                                            mirror=mirror)
 
     def __getitem__(self,key):
         return self.get_package(key)
@@ -65,72 +147,223 @@ class PackageConfig:
         self.git.call_success("add", self.absolute_filepath())
         self.git.call_success('commit', '-m', message);
 
+    # return the persistent BuildState of this plaur repository
+    def build_state(self):
+        with self.lock:
+            if self.build_state_record is None:
+                filename = os.path.join(self.git.plaur_dir(), 'build-state.json')
+                self.build_state_record = plaur.buildstate.BuildState(filename)
+            return self.build_state_record
+
+    # return the persistent DepGraph of this plaur repository
+    def depgraph(self):
+        with self.lock:
+            if self.dependency_graph is None:
+                filename = os.path.join(self.git.plaur_dir(), 'depgraph.json')
+                self.dependency_graph = plaur.depgraph.DepGraph(filename)
+            return self.dependency_graph
+
     def compute_depgraph(self,paths,provide_guessing = False):
         # provide-guessing: assume that each directory provides a package with
-        # the same name. (This only applies if the .SRCINFO does not exist)
+        # the same name. (This only applies if the .SRCINFO does not exist
+        # and can not be generated)
         # for the following computation, only paths specified in the paths
         # parameter are considered.
         # this method returns a pair of dictionaries:
-        # a dictionary that maps dependencies to the list of paths
-        # which require that dependency
-        dependencies = { }
-        # similarly, a dictionary that maps package name to the list of
-        # paths which provide that package name
-        provides = { }
-        for fullpath in paths:
-            package = self[fullpath]
-            try:
-                for i in package.dependencies():
-                    dependencies.setdefault(i,[]).append(package.path)
-                for i in package.provides():
-                    provides.setdefault(i,[]).append(package.path)
-            except FileNotFoundError as e:
-                debug("Can not open .SRCINFO of %s: %s" % (package.path, str(e)))
-                if provide_guessing:
-                    i = os.path.basename(package.path)
-                    print("Guessing that %s provides %s" % (package.path, i))
-                    provides.setdefault(i,[]).append(package.path)
+        # a dictionary that maps dependencies (possibly with a version
+        # constraint, e.g. "foo>=1.0") to the list of paths which require
+        # that dependency
+        # and similarly, a dictionary that maps package names and the
+        # constrained dependencies to the list of paths which provide that
+        # package name or satisfy that dependency
+        graph = self.depgraph()
+        missing = graph.update(self, paths)
+        (dependencies,provides) = graph.maps(paths)
+        if provide_guessing:
+            for path in paths:
+                if path in missing:
+                    i = os.path.basename(path)
+                    print("Guessing that %s provides %s" % (path, i))
+                    provides.setdefault(i,[]).append(path)
+                    # the version of a guessed package is unknown
+                    for dep in dependencies:
+                        if dep != i and split_dependency(dep)[0] == i:
+                            provides.setdefault(dep,[]).append(path)
+        graph.save()
+        self.save_srcinfo_cache()
         return (dependencies,provides)
 
+    # generate the .SRCINFO of those of the given packages that are verified,
+    # in parallel, and return the set of paths for which this succeeded.
+    # Running makepkg on unverified packages is not safe.
+    def generate_srcinfos(self, packages):
+        packages = [ p for p in packages if p.git.exists() and p.is_verified() ]
+        if not packages:
+            return set()
+        print("Generating .SRCINFO for: " + ' '.join(p.path for p in packages))
+        def generate(package):
+            package.generate_srcinfo()
+            return package.path
+        generated = set()
+        with ThreadPoolExecutor(os.cpu_count() or 1) as pool:
+            futures = [ (p, pool.submit(generate, p)) for p in packages ]
+            for package,f in futures:
+                try:
+                    generated.add(f.result())
+                except UserErrorMessage as e:
+                    error_msg(str(e))
+        return generated
+
+    # return the set of pairs (name, path) such that the dependency of path on
+    # the package name may be ignored in order to break a dependency cycle,
+    # as configured in the plaur.ini
+    def breakable_edges(self, paths):
+        edges = set()
+        for entry in plaur.main.config['cycle_breaks'].split():
+            (path, sep, name) = entry.partition(':')
+            if not sep or not path or not name:
+                raise UserErrorMessage("Invalid entry »%s« in cycle_breaks, expected PATH:NAME"
+                                       % entry)
+            edges.add((split_dependency(name)[0], os.path.normpath(path)))
+        if plaur.main.config.getboolean('break_cycles'):
+            edges |= self.depgraph().makedepends_only(paths)
+        return edges
+
     @staticmethod
-    def depsort(dependencies,provides):
+    def path_edges(dependencies,provides):
         # map dependencies/provides dicts as given in the compute_depgraph()
-        # function to a concrete order of the involved paths.
-        # for a path, it tells how many other paths need to be built before.
-        in_degree = { }
-        ready_to_build = queue.Queue() # paths that can be built immediately
-        # if a multiple paths P1 and P2 both provide the same package required
-        # by some other path B, then both P1 and P2 are built before B is.
-        path_provides = { } # map paths to packages it provides
-        for package,provided_by in provides.items():
+        # function to a dictionary that maps each path to a dictionary that
+        # maps each path it needs to the list of dependencies it needs it for.
+        # A path depending on a package it provides itself does not need
+        # itself.
+        edges = { }
+        for provided_by in provides.values():
             for path in provided_by:
-                # path provides package
-                in_degree[path] = 0;
-                path_provides.setdefault(path, []).append(package)
+                edges.setdefault(path, { })
         for dep,required_by in dependencies.items():
             for path in required_by:
-                in_degree.setdefault(path, 0)
-                in_degree[path] += len(provides.get(dep, []))
-        for path,degree in in_degree.items():
-            if degree == 0:
-                ready_to_build.put(path)
+                needs = edges.setdefault(path, { })
+                for provider in provides.get(dep, []):
+                    if provider != path:
+                        needs.setdefault(provider, []).append(dep)
+        return edges
+
+    @staticmethod
+    def strongly_connected_components(edges):
+        # Tarjan's algorithm on the graph given by the dictionary as returned
+        # by path_edges(). It is iterative, such that long dependency chains
+        # do not hit the recursion limit. Returns the list of components, each
+        # being a list of paths.
+        index = { } # the order in which the paths are visited
+        lowlink = { }
+        stack = [ ]
+        on_stack = set()
+        components = [ ]
+        for root in edges:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [ (root, iter(edges[root])) ]
+            while work:
+                (path, needed) = work[-1]
+                for n in needed:
+                    if n not in index:
+                        index[n] = lowlink[n] = len(index)
+                        stack.append(n)
+                        on_stack.add(n)
+                        work.append((n, iter(edges.get(n, { }))))
+                        break
+                    elif n in on_stack:
+                        lowlink[path] = min(lowlink[path], index[n])
+                else:
+                    # all paths needed by path are visited
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[path])
+                    if lowlink[path] == index[path]:
+                        component = [ ]
+                        while True:
+                            n = stack.pop()
+                            on_stack.remove(n)
+                            component.append(n)
+                            if n == path:
+                                break
+                        components.append(component)
+        return components
+
+    @staticmethod
+    def break_cycles(edges,breakable):
+        # remove all edges within dependency cycles from the dictionary edges
+        # as returned by path_edges(), if all dependencies of the edge are
+        # breakable, i.e. if the pair (name, path) is in the set breakable for
+        # the package name of each dependency. Returns the list of triples
+        # (path, needed path, dependencies) of the removed edges.
+        broken = [ ]
+        for component in PackageConfig.strongly_connected_components(edges):
+            if len(component) < 2:
+                continue
+            members = set(component)
+            for path in component:
+                for needed,deps in list(edges[path].items()):
+                    if needed not in members:
+                        continue
+                    if all((split_dependency(d)[0], path) in breakable for d in deps):
+                        del edges[path][needed]
+                        broken.append((path, needed, deps))
+        # removing edges only splits components, so the remaining components
+        # consist of edges that are not breakable.
+        return broken
+
+    @staticmethod
+    def depsort(dependencies,provides,breakable=frozenset()):
+        # map dependencies/provides dicts as given in the compute_depgraph()
+        # function to a concrete order of the involved paths.
+        # if a multiple paths P1 and P2 both provide the same package required
+        # by some other path B, then both P1 and P2 are built before B is.
+        # Dependency cycles are reported with the edges forming them and are
+        # left out, just as all paths depending on them. Cycles can be broken
+        # by the edges in breakable, see break_cycles().
+        edges = PackageConfig.path_edges(dependencies, provides)
+        order = { path: i for i,path in enumerate(edges) }
+        for (path,needed,deps) in PackageConfig.break_cycles(edges, breakable):
+            print("Breaking a dependency cycle by ignoring that %s needs %s (%s)"
+                  % (path, needed, ' '.join(deps)))
+        cyclic = set()
+        for component in PackageConfig.strongly_connected_components(edges):
+            if len(component) < 2:
+                continue
+            component.sort(key=order.get)
+            cyclic.update(component)
+            msg = "Ignoring packages because of cyclic dependencies: "
+            msg += ' '.join(component)
+            for path in component:
+                for needed,deps in edges[path].items():
+                    if needed in component:
+                        msg += "\n  %s needs %s (%s)" % (path, needed, ' '.join(deps))
+            error_msg(msg)
+        # for a path, it tells how many other paths need to be built before.
+        in_degree = { path: len(needed) for path,needed in edges.items() }
+        needed_by = { path: [ ] for path in edges }
+        for path,needed in edges.items():
+            for n in needed:
+                needed_by[n].append(path)
+        # paths that can be built immediately
+        ready_to_build = collections.deque([ p for p,d in in_degree.items() if d == 0 ])
         topsorted = [ ]
-        while not ready_to_build.empty():
-            path = ready_to_build.get(block = False)
+        while ready_to_build:
+            path = ready_to_build.popleft()
             topsorted.append(path)
-            for provs in path_provides[path]:
-                for next_path in dependencies.get(provs, []):
-                    in_degree[next_path] -= 1;
-                    assert(in_degree[next_path] >= 0)
-                    if (in_degree[next_path] <= 0):
-                        ready_to_build.put(next_path)
-        cyclic_deps = []
-        for path,degree in in_degree.items():
-            if degree > 0:
-                cyclic_deps.append(path)
-        if cyclic_deps:
-            msg = "Ignoring packages because of cyclic dependencies: "
-            msg += ' '.join(cyclic_deps)
+            for next_path in needed_by[path]:
+                in_degree[next_path] -= 1
+                if in_degree[next_path] == 0:
+                    ready_to_build.append(next_path)
+        blocked = [ p for p,d in in_degree.items() if d > 0 and p not in cyclic ]
+        if blocked:
+            msg = "Ignoring packages because they depend on a dependency cycle: "
+            msg += ' '.join(blocked)
             error_msg(msg)
         return topsorted
 
@@ -158,3 +391,17 @@ class PackageConfig:
             'n3' : [ 'someprotocolpath', 'p1' ],
         }
         print (' '.join(PackageConfig.depsort(dependencies, provides)))
+        # c1 and c2 form a cycle, which d depends on
+        dependencies = {
+            'c1' : [ 'c2' ],
+            'c2' : [ 'c1' ],
+            'c' : [ 'd' ],
+        }
+        provides = {
+            'c1' : [ 'c1' ],
+            'c2' : [ 'c2' ],
+            'c' : [ 'c1' ],
+            'd' : [ 'd' ],
+        }
+        print (' '.join(PackageConfig.depsort(dependencies, provides)))
+        print (' '.join(PackageConfig.depsort(dependencies, provides, { ('c2', 'c1') })))
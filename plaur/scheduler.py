@@ -0,0 +1,270 @@
+"""build the packages of a dependency graph in parallel"""
+
+import collections
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import plaur.package as P
+from plaur.utils import *
+
+
+class CpuBudget:
+    # distributes a number of CPU slots among concurrent builds. Each build
+    # acquires its slots when it starts and they are exported to makepkg as
+    # MAKEFLAGS=-jN. The free slots are split evenly among the builds that
+    # start at the same time, so a build that starts alone gets all of them.
+    # If all slots are in use, a build waits until a running build finishes,
+    # so the total is never exceeded. The MAKEFLAGS of a running build can
+    # not change, so a build keeps its slots even if it is the last one
+    # running; only the Jobserver hands the freed slots to it.
+    def __init__(self, total=None):
+        self.total = max(1, total or os.cpu_count() or 1)
+        self.used = 0
+        self.lock = threading.Condition()
+
+    # acquire slots for a build that starts together with competitors - 1
+    # other builds and return the number of slots. Blocks until at least one
+    # slot is free.
+    def acquire(self, competitors=1):
+        with self.lock:
+            while self.used >= self.total:
+                self.lock.wait()
+            free = self.total - self.used
+            slots = max(1, free // max(1, competitors))
+            self.used += slots
+            return slots
+
+    def release(self, slots):
+        with self.lock:
+            self.used -= slots
+            self.lock.notify_all()
+
+    # return the environment variables and the file descriptors to pass to
+    # makepkg for a build with the given number of slots
+    def makeflags(self, slots):
+        return ({ 'MAKEFLAGS': '-j%d' % slots }, ())
+
+    def close(self):
+        pass
+
+
+class Jobserver(CpuBudget):
+    # shares the CPU slots among all concurrent builds via a GNU make
+    # jobserver: a pipe holding one token per slot. Every make started by a
+    # build takes tokens from it while running jobs, so a lone remaining
+    # build automatically uses all slots. Every make also runs one job
+    # without a token, so the total can be exceeded by the number of
+    # concurrent builds minus one.
+    def __init__(self, total=None):
+        CpuBudget.__init__(self, total)
+        (self.read_fd, self.write_fd) = os.pipe()
+        os.write(self.write_fd, b'+' * (self.total - 1))
+
+    def acquire(self, competitors=1):
+        return self.total
+
+    def release(self, slots):
+        pass
+
+    def makeflags(self, slots):
+        auth = '%d,%d' % (self.read_fd, self.write_fd)
+        flags = '-j%d --jobserver-auth=%s --jobserver-fds=%s' % (self.total, auth, auth)
+        return ({ 'MAKEFLAGS': flags }, (self.read_fd, self.write_fd))
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+class BuildScheduler:
+    # builds paths of a PackageConfig with up to jobs concurrent makepkg
+    # workers. A path is started as soon as all paths providing one of its
+    # dependencies are built and installed. If a build fails, all paths
+    # depending on it (transitively) are skipped, but the rest goes on.
+    # dependencies and provides are the dictionaries as returned by
+    # PackageConfig.compute_depgraph().
+    status_interval = 30 # seconds between two live summaries
+
+    # If a CpuBudget is given, then the CPU slots of each build are taken
+    # from there. Packages needed by other builds are always installed, the
+    # others only if install is set.
+    def __init__(self, packs, dependencies, provides, jobs=1, budget=None):
+        self.packs = packs
+        self.dependencies = dependencies
+        self.provides = provides
+        self.jobs = max(1, jobs)
+        self.budget = budget
+
+    # compute a pair of dictionaries: the first maps each of the given paths
+    # to the set of paths it waits for, the second maps each path to the set
+    # of paths waiting for it. Since the paths are topologically sorted, a
+    # path never waits for a later one; such a dependency was ignored by
+    # depsort() to break a cycle.
+    def edges(self, paths):
+        position = { p: i for i,p in enumerate(paths) }
+        prerequisites = { p: set() for p in paths }
+        dependents = { p: set() for p in paths }
+        for dep,required_by in self.dependencies.items():
+            for provider in self.provides.get(dep, []):
+                if provider not in position:
+                    continue
+                for path in required_by:
+                    if path in position and position[path] > position[provider]:
+                        prerequisites[path].add(provider)
+                        dependents[provider].add(path)
+        return (prerequisites, dependents)
+
+    # the job running in a worker thread: returns 'built', 'uptodate',
+    # 'failed' or 'unverified'
+    def build_one(self, path, slots):
+        try:
+            package = self.packs[path]
+            print(":: %s: fetching sources..." % package.path)
+            package.fetch_sources()
+            if package.is_built():
+                print(":: %s: Built packages up to date" % package.path)
+                return 'uptodate'
+            if self.budget is None:
+                return 'built' if package.build() else 'failed'
+            (env, fds) = self.budget.makeflags(slots)
+            debug("Building %s with %s" % (path, env))
+            return 'built' if package.build(env=env, pass_fds=fds) else 'failed'
+        except P.PackageUnverified as e:
+            return 'unverified'
+        except (UserErrorMessage, OSError) as e:
+            # e.g. a missing checkout or makepkg not being found: only this
+            # path and its dependents fail
+            print(":: %s: %s" % (path, e))
+            return 'failed'
+        finally:
+            if self.budget is not None:
+                self.budget.release(slots)
+
+    # install the packages of the given paths in one pacman transaction, as
+    # far as necessary, and return whether this succeeded. This happens in
+    # the main thread, such that pacman is never run concurrently.
+    def install(self, paths):
+        packages = [ ]
+        for path in paths:
+            package = self.packs[path]
+            if package.is_built() and package.uninstalled_packages():
+                packages.append(package)
+            else:
+                print(":: %s: Installed packages up to date" % package.path)
+        if not packages:
+            return True
+        print(":: Installing: " + ' '.join(p.path for p in packages))
+        return P.Package.install(packages)
+
+    # install those of the built paths not installed yet that are in the
+    # given set. If this fails, they count as failed.
+    def install_pending(self, paths, outcome, dependents, ready):
+        batch = [ p for p in self.pending if p in paths ]
+        if not batch:
+            return
+        self.pending = [ p for p in self.pending if p not in paths ]
+        if self.install(batch):
+            return
+        for path in batch:
+            outcome[path] = 'failed'
+            self.skip_dependents(path, outcome, dependents)
+        remaining = [ p for p in ready if p not in outcome ]
+        ready.clear()
+        ready.extend(remaining)
+
+    def print_workers(self, running, now):
+        cells = [ ]
+        for worker,(path,start) in sorted(running.items()):
+            cells.append("[%d] %s (%s)" % (worker, path, format_duration(now - start)))
+        print(":: Running: " + ' | '.join(cells))
+
+    # build the given paths, which are expected to be topologically sorted,
+    # and return a dictionary mapping every path to its outcome: one of the
+    # results of build_one() or 'skipped'. Built packages are installed in
+    # batches: right before a path is started, everything it needs is
+    # installed together with everything the other ready paths need, and
+    # the remaining packages are installed at the end.
+    def run(self, paths):
+        (prerequisites, dependents) = self.edges(paths)
+        waiting_for = { p: len(prerequisites[p]) for p in paths }
+        ready = collections.deque([ p for p in paths if waiting_for[p] == 0 ])
+        outcome = { }
+        running = { } # maps worker ids to pairs (path, start time)
+        futures = { } # maps futures to worker ids
+        self.pending = [ ] # paths built, but not installed yet
+        last_summary = time.monotonic()
+        with ThreadPoolExecutor(self.jobs) as pool:
+            while ready or futures:
+                if ready and len(futures) < self.jobs:
+                    needed = set()
+                    for p in ready:
+                        needed |= prerequisites[p]
+                    self.install_pending(needed, outcome, dependents, ready)
+                while ready and len(futures) < self.jobs:
+                    # the builds starting now share the free slots
+                    competitors = min(len(ready), self.jobs - len(futures))
+                    slots = 0
+                    if self.budget is not None:
+                        slots = self.budget.acquire(competitors)
+                    path = ready.popleft()
+                    worker = min(set(range(1, self.jobs + 1)) - set(running))
+                    if self.jobs > 1:
+                        print(":: [%d] starting %s" % (worker, path))
+                    running[worker] = (path, time.monotonic())
+                    futures[pool.submit(self.build_one, path, slots)] = worker
+                (done, _) = wait(list(futures), timeout=self.status_interval,
+                                 return_when=FIRST_COMPLETED)
+                now = time.monotonic()
+                for f in done:
+                    worker = futures.pop(f)
+                    (path, start) = running.pop(worker)
+                    outcome[path] = f.result()
+                    self.finish(path, outcome, dependents, waiting_for, ready)
+                    if self.jobs > 1:
+                        print(":: [%d] %s %s after %s" % (worker, path, outcome[path],
+                                                       format_duration(now - start)))
+                if running and self.jobs > 1 and now - last_summary >= self.status_interval:
+                    self.print_workers(running, now)
+                    last_summary = now
+        self.install_pending(set(self.pending), outcome, dependents, ready)
+        for path in paths:
+            if path not in outcome:
+                # e.g. because of a dependency cycle
+                outcome[path] = 'skipped'
+        return outcome
+
+    def finish(self, path, outcome, dependents, waiting_for, ready):
+        if outcome[path] == 'unverified':
+            print(":: Skipping unverified %s" % path)
+        elif outcome[path] == 'failed':
+            self.skip_dependents(path, outcome, dependents)
+            return
+        else:
+            self.pending.append(path)
+        for d in dependents[path]:
+            waiting_for[d] -= 1
+            if waiting_for[d] == 0 and d not in outcome:
+                ready.append(d)
+
+    # skip everything that depends on the failed path
+    @staticmethod
+    def skip_dependents(path, outcome, dependents):
+        todo = [ path ]
+        while todo:
+            for d in dependents[todo.pop()]:
+                if d not in outcome:
+                    outcome[d] = 'skipped'
+                    print(":: Skipping %s, because %s failed" % (d, path))
+                    todo.append(d)
+
+    @staticmethod
+    def print_summary(outcome):
+        counts = { }
+        for path,result in outcome.items():
+            counts.setdefault(result, []).append(path)
+        print(":: Summary: " + ', '.join("%d %s" % (len(l), r) for r,l in sorted(counts.items())))
+        for r in ['failed', 'skipped', 'unverified']:
+            if r in counts:
+                print("   %s: %s" % (r, ' '.join(sorted(counts[r]))))
@@ -1,18 +1,46 @@
-
 """parse a .SRCINFO file and provide some wrapper functions"""
 
+import json
+import os
 import re
-from plaur.utils import UserErrorMessage
+import threading
+from plaur.utils import UserErrorMessage, debug
+
+# characters that must not occur in the key of a .SRCINFO line
+key_forbidden = re.compile('[= \\t]')
+# the package name at the beginning of a dependency like "foo>=1.0"
+only_name = re.compile('^[^<>=]*')
+
+class PackageName:
+    def __init__(self,name,ver,rel,arch,epoch=None):
+        self.name = name
+        self.ver = ver
+        self.rel = rel
+        self.arch = arch
+        self.epoch = epoch
+        self.suffix = '.pkg.tar.xz'
+    def version(self):
+        # the version as pacman reports it for the installed package
+        version = self.ver + '-' + self.rel
+        if self.epoch:
+            version = self.epoch + ':' + version
+        return version
+    def __str__(self):
+        pattern = [self.name, self.ver, self.rel, self.arch]
+        return '-'.join(pattern) + self.suffix
 
 class SRCINFO:
     def __init__(self, filepath):
         self.filepath = filepath
         # sections is a dictionary that maps pairs (e.g. ("pkgname","plaur")) to
-        # section dictionaries. Each section dictionary maps keys to a list of
-        # values
-        # TODO: keep the order of sections fix if their order matters in the
-        #       .SRCINFO specification
+        # section dictionaries, in the order of the .SRCINFO. Each section
+        # dictionary maps keys to a list of values
         self.sections = { }
+        # the options of the pkgbase section, which serve as the fallback for
+        # the pkgname sections
+        self.base = { }
+        # maps keys to the list of values in all sections
+        self.any_index = { }
         self.loaded_once = False
 
     def load(self):
@@ -21,46 +49,42 @@ class SRCINFO:
             self.loaded_once = True
 
     def reload(self):
-        self.sections = { }
         with open(self.filepath, 'r') as f:
-            lines = f.readlines()
-        is_emptyline = re.compile('^[ \\t]*(#.*)?$')
-        is_header = re.compile('^(?P<name>[^= \\t]+) = (?P<value>.*)$')
-        is_option = re.compile('^\t(?P<name>[^= \\t]+) = (?P<value>.*)$')
-        current_section = { }
-        current_header = None
-        class Holder(object):
-            def set(self, v):
-                self.v = v
-                return v
-            def get(self):
-                return self.v
-        h = Holder()
+            self.parse(f)
+
+    # parse the given lines of a .SRCINFO in a single pass
+    def parse(self, lines):
+        sections = { }
+        current_section = None
         for i, line in enumerate(lines):
             line = line.rstrip('\r\n')
-            if (is_emptyline.match(line)):
-                #print("%d SKIP %s" % (i,line))
+            stripped = line.lstrip(' \t')
+            if stripped == '' or stripped[0] == '#':
                 continue
-            elif h.set(is_header.match(line)):
-                #print("%d header %s" %(i,line))
-                if current_header != None:
-                    self.sections[current_header] = current_section
-                current_header = (h.get().group('name'),h.get().group('value'))
-                current_section = { }
-            elif h.set(is_option.match(line)):
-                name = h.get().group('name')
-                if not name in current_section:
-                    current_section[name] = [ ]
-                current_section[name].append(h.get().group('value'))
-            else:
+            is_option = line[0] == '\t'
+            (name,sep,value) = (line[1:] if is_option else line).partition(' = ')
+            if sep == '' or name == '' or key_forbidden.search(name):
                 raise UserErrorMessage("Line %d: unrecognized syntax: \"%s\"" % (i+1, line))
-        # save the last section
-        if current_header != None:
-            self.sections[current_header] = current_section
-        #print(self.sections)
+            if not is_option:
+                current_section = { }
+                sections[(name,value)] = current_section
+            elif current_section is not None:
+                current_section.setdefault(name, []).append(value)
+        self.set_sections(sections)
     # example usage:
     # SRCINFO('.SRCINFO').reload()
 
+    # set the sections and build the indices for the queries
+    def set_sections(self, sections):
+        self.sections = sections
+        self.base = { }
+        self.any_index = { }
+        for (sectype,secname),options in sections.items():
+            for key,values in options.items():
+                if sectype == "pkgbase":
+                    self.base.setdefault(key, []).extend(values)
+                self.any_index.setdefault(key, []).extend(values)
+
     def __str__(self):
         buf = ""
         for (sectype,secname),section in self.sections.items():
@@ -78,30 +102,20 @@ class SRCINFO:
 
     def query_pkgname(self,pkgname,key):
         # TODO: look up the precise semantics of .SRCINFO
-        value = []
-        fallback_value = []
-        for (sectype,secname),options in self.sections.items():
-            if sectype == "pkgname" and secname == pkgname:
-                if key in options:
-                    value += options[key]
-            if sectype == "pkgbase":
-                if key in options:
-                    fallback_value += options[key]
-        if value == []:
-            value = fallback_value
-        return value
+        value = self.sections.get(("pkgname",pkgname), {}).get(key)
+        if not value:
+            value = self.base.get(key, [])
+        return list(value)
+
+    def full_version(self,pkgname):
+        # the version "epoch:pkgver-pkgrel" as compared by vercmp
+        version = '-'.join(self.query_pkgname(pkgname,'pkgver')[0:1]
+                           + self.query_pkgname(pkgname,'pkgrel')[0:1])
+        for epoch in self.query_pkgname(pkgname,'epoch')[0:1]:
+            version = epoch + ':' + version
+        return version
 
     def package_names(self):
-        class PackageName:
-            def __init__(self,name,ver,rel,arch):
-                self.name = name
-                self.ver = ver
-                self.rel = rel
-                self.arch = arch
-                self.suffix = '.pkg.tar.xz'
-            def __str__(self):
-                pattern = [self.name, self.ver, self.rel, self.arch]
-                return '-'.join(pattern) + self.suffix
         res = [ ]
         for name in self.packages():
             ver = self.query_pkgname(name,'pkgver')[0]
@@ -109,22 +123,174 @@ class SRCINFO:
             arches = self.query_pkgname(name,'arch')
             default_arch = 'x86_64'
             arch = 'any' if 'any' in arches else default_arch
-            res.append(PackageName(name,ver,rel,arch))
+            epoch = (self.query_pkgname(name,'epoch') or [None])[0]
+            res.append(PackageName(name,ver,rel,arch,epoch))
         return res
 
     def query_any(self,key):
-        value = []
-        for (sectype,secname),options in self.sections.items():
-            if key in options:
-                value += options[key]
-        return value
+        return list(self.any_index.get(key, []))
 
     @staticmethod
     def drop_version_constraints(deplist):
         """From a list of dependencies, drop all the versioning constraints,
         resulting in a traversable object of package names
         """
-        only_name = re.compile('^[^<>=]*')
         for i in deplist:
             yield only_name.search(i).group(0)
 
+class SRCINFOCache:
+    # a persistent cache of parsed .SRCINFO files, saved as JSON. It maps
+    # keys identifying the content of a .SRCINFO to its sections. For files
+    # in a working tree, the key consists of the path, the modification time,
+    # the size and the inode of the file.
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = None # loaded on demand
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # load the given SRCINFO object from the file path within the given
+    # commit of the Git repository. Since commits never change, the cache
+    # entry is keyed by the commit and the path. Returns False if the file
+    # does not exist in the commit (or the commit does not exist).
+    def load_commit(self, srcinfo, git, commit, path='.SRCINFO'):
+        key = SRCINFOCache.commit_key(commit, path)
+        if self.load_key(srcinfo, key):
+            return True
+        batch = git.batch_cat()
+        data = batch.read('%s:%s' % (commit, path))
+        # usually, only one file is read per repository, and keeping a
+        # process per package would exhaust the file descriptors
+        batch.close()
+        if data is None:
+            return False
+        self.misses += 1
+        srcinfo.parse(data.decode('utf-8').splitlines())
+        self.store(key, srcinfo)
+        return True
+
+    # add the files at path within the given commits to the cache, reading
+    # them all via the given BatchCheck, which needs to know the objects of
+    # all commits. Commits without such a file and files that can not be
+    # parsed are skipped, load_commit() reports them later.
+    def load_commits(self, batch, commits, path='.SRCINFO'):
+        for commit in commits:
+            key = SRCINFOCache.commit_key(commit, path)
+            if self.contains(key):
+                continue
+            data = batch.read('%s:%s' % (commit, path))
+            if data is None:
+                continue
+            srcinfo = SRCINFO(None)
+            try:
+                srcinfo.parse(data.decode('utf-8').splitlines())
+            except (UserErrorMessage, UnicodeDecodeError) as e:
+                debug("Can not parse %s of %s: %s" % (path, commit, str(e)))
+                continue
+            self.misses += 1
+            self.store(key, srcinfo)
+
+    @staticmethod
+    def commit_key(commit, path='.SRCINFO'):
+        return 'commit:%s:%s' % (commit, path)
+
+    # tell whether there is an entry with the given key
+    def contains(self, key):
+        with self.lock:
+            if self.entries is None:
+                self.read()
+            return key in self.entries
+
+    # load the given SRCINFO object from the entry with the given key and
+    # return True, or return False if there is no such entry
+    def load_key(self, srcinfo, key):
+        with self.lock:
+            if self.entries is None:
+                self.read()
+            entry = self.entries.get(key)
+        if entry is None:
+            return False
+        self.hits += 1
+        srcinfo.set_sections({ (t,n): options for t,n,options in entry })
+        return True
+
+    # add the sections of the given SRCINFO object to the cache
+    def store(self, key, srcinfo):
+        with self.lock:
+            if self.entries is None:
+                self.read()
+        entry = [ [t,n,options] for (t,n),options in srcinfo.sections.items() ]
+        with self.lock:
+            self.entries[key] = entry
+            self.dirty = True
+
+    # the common prefix of the keys of all versions of a file
+    @staticmethod
+    def file_prefix(filepath):
+        return 'stat:%s:' % os.path.realpath(filepath)
+
+    @staticmethod
+    def stat_key(filepath):
+        st = os.stat(filepath)
+        return SRCINFOCache.file_prefix(filepath) \
+            + '%d:%d:%d' % (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def read(self):
+        self.entries = { }
+        try:
+            with open(self.filename) as fh:
+                self.entries = json.load(fh)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            debug("Ignoring broken SRCINFO cache %s: %s" % (self.filename, str(e)))
+
+    # load the given SRCINFO object from the cache, or parse its file and add
+    # it to the cache. Raises FileNotFoundError if the file does not exist.
+    def load(self, srcinfo):
+        key = SRCINFOCache.stat_key(srcinfo.filepath)
+        with self.lock:
+            if self.entries is None:
+                self.read()
+            entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            srcinfo.set_sections({ (t,n): options for t,n,options in entry })
+            return
+        self.misses += 1
+        srcinfo.reload()
+        entry = [ [t,n,options] for (t,n),options in srcinfo.sections.items() ]
+        with self.lock:
+            # drop the entries of older versions of the same file
+            prefix = SRCINFOCache.file_prefix(srcinfo.filepath)
+            for k in [ k for k in self.entries if k.startswith(prefix) ]:
+                del self.entries[k]
+            self.entries[key] = entry
+            self.dirty = True
+
+    # drop the entries read from or generated for commits that are not in
+    # the given set, e.g. because the packages were verified again since
+    def prune_commits(self, commits):
+        with self.lock:
+            if self.entries is None:
+                # nothing was loaded, so nothing was added either
+                return
+            for key in list(self.entries):
+                (kind, _, rest) = key.partition(':')
+                if kind in ('commit', 'generated') and rest.split(':')[0] not in commits:
+                    del self.entries[key]
+                    self.dirty = True
+
+    # write the cache file if something changed
+    def save(self):
+        debug("SRCINFO cache: %d hits, %d misses" % (self.hits, self.misses))
+        with self.lock:
+            if not self.dirty:
+                return
+            tmpfile = self.filename + '.tmp'
+            with open(tmpfile, 'w') as fh:
+                json.dump(self.entries, fh)
+            os.replace(tmpfile, self.filename)
+            self.dirty = False
@@ -1,8 +1,8 @@
+import os
 import sys
 import re
 
 import pyalpm
-import pycman
 
 program_name = "?"
 
@@ -21,7 +21,8 @@ class PackageUnverified(Exception):
         return "Package %s not verified" % self.path
 
 def debug(*objs):
-    #print("Debug: ", *objs, file=sys.stderr)
+    if os.environ.get('PLAUR_DEBUG'):
+        print("Debug: ", *objs, file=sys.stderr)
     return True
 
 def error_msg(*objs):
@@ -60,15 +61,23 @@ def getTerminalSize():
 class ProgressBar:
     def __init__(self, progress = 0.0):
         self.progress = progress
+        self.text = ''
 
-    def set(self,progress):
+    # set the progress (between 0.0 and 1.0) and optionally a short text
+    # shown in front of the bar
+    def set(self,progress,text=None):
         self.progress = progress
+        if text is not None:
+            self.text = text
         self.redraw()
 
     def redraw(self):
         string = "\033[s\033[0;0H"
         (width, _) = getTerminalSize()
-        width = width - 2
+        text = self.text + ' ' if self.text else ''
+        text = text[0:width // 2]
+        string += text
+        width = width - 2 - len(text)
         for i in range(0, width):
             tick = int(self.progress * width)
             if i == tick:
@@ -80,6 +89,16 @@ class ProgressBar:
         string += '\033[0;0H\n\033[u'
         print(string, end="", flush=True)
 
+# format a duration given in seconds in a human readable way
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "%ds" % seconds
+    elif seconds < 3600:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    else:
+        return "%dh%02dm" % (seconds // 3600, (seconds % 3600) // 60)
+
 # thanks to http://stackoverflow.com/questions/510357/python-read-a-single-character-from-the-user
 class _GetchUnix:
     def __init__(self):
@@ -112,19 +131,172 @@ def ask(message,default_yes=True):
     else:
         return default_yes
 
+# a dependency like "foo>=1.0": the name, optionally followed by a comparison
+# operator and a version
+dependency_re = re.compile('^(?P<name>[^<>=]*)((?P<op><=|>=|=|<|>)(?P<version>.*))?$')
+
+def split_dependency(dep):
+    """Split a dependency like "foo>=1.0" into the triple (name, operator,
+    version). For a dependency without a constraint, operator and version
+    are None."""
+    m = dependency_re.match(dep)
+    return (m.group('name'), m.group('op'), m.group('version'))
+
+def version_satisfies(version, op, constraint):
+    """Tell whether the given version satisfies the constraint given by the
+    comparison operator op and the version constraint. If op is None, every
+    version satisfies it. A version of None (i.e. an unversioned provides)
+    does not satisfy any actual constraint, just as for pacman."""
+    if op is None:
+        return True
+    if version is None:
+        return False
+    cmp = pyalpm.vercmp(version, constraint)
+    return {
+        '<': cmp < 0,
+        '<=': cmp <= 0,
+        '=': cmp == 0,
+        '>=': cmp >= 0,
+        '>': cmp > 0,
+    }[op]
+
+# the PKGEXT of makepkg if it is set neither in the environment nor in a
+# makepkg.conf
+default_pkgext = '.pkg.tar.xz'
+pkgext_re = re.compile('^\\s*PKGEXT=([\'"]?)([^\'"\\s#]*)\\1')
+pkgext_cache = None
+
+def makepkg_conf_files():
+    """Return the makepkg.conf files in the order makepkg reads them"""
+    files = [ os.environ.get('MAKEPKG_CONF', '/etc/makepkg.conf') ]
+    conf_d = '/etc/makepkg.conf.d'
+    if os.path.isdir(conf_d):
+        files += sorted(os.path.join(conf_d, f) for f in os.listdir(conf_d)
+                        if f.endswith('.conf'))
+    config_home = os.environ.get('XDG_CONFIG_HOME', os.path.expanduser('~/.config'))
+    user_conf = os.path.join(config_home, 'pacman', 'makepkg.conf')
+    if not os.path.isfile(user_conf):
+        user_conf = os.path.expanduser('~/.makepkg.conf')
+    files.append(user_conf)
+    return files
+
+def makepkg_pkgext():
+    """Return the file extension of the packages built by makepkg, taken
+    from the environment or else from the makepkg.conf files"""
+    global pkgext_cache
+    if pkgext_cache is None:
+        pkgext = os.environ.get('PKGEXT')
+        if not pkgext:
+            pkgext = default_pkgext
+            for filename in makepkg_conf_files():
+                try:
+                    with open(filename) as fh:
+                        for line in fh:
+                            m = pkgext_re.match(line)
+                            if m:
+                                pkgext = m.group(2)
+                except OSError:
+                    pass
+        pkgext_cache = pkgext
+    return pkgext_cache
+
 def colored_header(message):
     return ("\033[0;33m========\033[1;37m %s \033[0;33m========\033[0m\n" % message)
 
 class ALPM:
     pacman_config = None
     alpm_handle = None
+    # maps database names to their AlpmIndex
+    indices = { }
     @staticmethod
     def get():
         if ALPM.alpm_handle == None:
+            # pycman is only imported on demand, because it is slow to load
+            import pycman.config
             ALPM.pacman_config = pycman.config.PacmanConfig(conf = '/etc/pacman.conf')
             ALPM.alpm_handle = ALPM.pacman_config.initialize_alpm()
         return ALPM.alpm_handle
 
+    @staticmethod
+    def index(db):
+        """Return the AlpmIndex of the given database, which is built only
+        once per process"""
+        if db.name not in ALPM.indices:
+            ALPM.indices[db.name] = AlpmIndex(db.pkgcache)
+        return ALPM.indices[db.name]
+
+    @staticmethod
+    def local_snapshot():
+        """Return the AlpmIndex of the installed packages. It is taken once
+        per process and then kept up to date by installed()"""
+        return ALPM.index(ALPM.get().get_localdb())
+
+    @staticmethod
+    def installed(pkg):
+        """Record in the snapshot of the local database that the package
+        (e.g. an InstalledPackage) was installed"""
+        if ALPM.alpm_handle is None:
+            # no snapshot was taken yet
+            return
+        local_name = ALPM.alpm_handle.get_localdb().name
+        if local_name in ALPM.indices:
+            ALPM.indices[local_name].add(pkg)
+
+class InstalledPackage:
+    """The attributes of a pyalpm.Package that the AlpmIndex needs, for
+    packages installed after the snapshot of the local database was taken"""
+    def __init__(self, name, version, provides):
+        self.name = name
+        self.version = version
+        self.provides = provides
+
+class AlpmIndex:
+    """An index of the packages of an alpm database by their names and by the
+    names they provide, such that finding a satisfier of a dependency does
+    not scan the entire database like pyalpm.find_satisfier() does"""
+    def __init__(self, packages):
+        # maps names to lists of pairs (version, package), where version is
+        # None for a provides without a version
+        self.index = { }
+        # maps package names to packages
+        self.packages = { }
+        for pkg in packages:
+            self.add(pkg)
+
+    def add(self, pkg):
+        """Add the package, replacing the package of the same name"""
+        self.remove(pkg.name)
+        self.packages[pkg.name] = pkg
+        self.index.setdefault(pkg.name, []).append((pkg.version, pkg))
+        for prov in pkg.provides:
+            (name, op, version) = split_dependency(prov)
+            self.index.setdefault(name, []).append((version if op == '=' else None, pkg))
+
+    def remove(self, name):
+        pkg = self.packages.pop(name, None)
+        if pkg is None:
+            return
+        for n in [ name ] + [ split_dependency(p)[0] for p in pkg.provides ]:
+            self.index[n] = [ e for e in self.index[n] if e[1] is not pkg ]
+
+    def get(self, name):
+        """Return the package of the given name, or None"""
+        return self.packages.get(name)
+
+    def version(self, name):
+        """Return the version of the package of the given name, or None"""
+        pkg = self.packages.get(name)
+        return None if pkg is None else pkg.version
+
+    def find_satisfier(self, dep):
+        """Return a package satisfying the dependency dep, e.g. "foo>=1.0",
+        or None"""
+        (name, op, constraint) = split_dependency(dep)
+        for version,pkg in self.index.get(name, []):
+            if version_satisfies(version, op, constraint):
+                return pkg
+        return None
+
 def alpm_depcheck(packages):
     # check the availability of the package names 'packages'
     # in the packman repository and return three (not necessarily disjoint!)
@@ -148,21 +320,21 @@ missing     = %s
 installed   = %s""" % (sep.join(self.repoinstall), sep.join(self.repoignore), sep.join(self.missing), sep.join(self.installed))
     res = DepCheckResult()
     alpm = ALPM.get()
-    local_db = alpm.get_localdb()
+    local_db = ALPM.index(alpm.get_localdb())
     dbs = alpm.get_syncdbs()
     repo_ignore_re = re.compile("thorsten")
     for dep in packages:
         is_installed = False
-        if pyalpm.find_satisfier(local_db.pkgcache, dep):
+        if local_db.find_satisfier(dep):
             res.installed.append(dep)
             is_installed = True
         repo_found = False
         for db in dbs:
             match = repo_ignore_re.match(db.name)
-            if match and match.end() == len(db.name) and db.get_pkg(dep):
+            if match and match.end() == len(db.name) and db.get_pkg(split_dependency(dep)[0]):
                 res.repoignore.append(dep)
                 continue
-            pkg = pyalpm.find_satisfier(db.pkgcache, dep)
+            pkg = ALPM.index(db).find_satisfier(dep)
             if pkg is not None:
                 #print("%s is in repo %s" % (dep,db.name))
                 repo_found = True